@@ -30,3 +30,122 @@ def run_async(func):
         return func_hl
 
     return async_func
+
+
+class SingleFlight:
+    """
+        SingleFlight()
+            coalesces concurrent calls for the same key.  The first caller
+            for a key runs the function, and every caller that arrives for
+            the same key while it is running waits for its result instead of
+            running it again.
+
+            calls counts every call, and shared counts the calls that were
+            answered by another caller's run.
+
+            E.g.:
+            flight = SingleFlight()
+
+            def handle(start, dest):
+                return flight.do((start, dest), route, start, dest)
+
+            >>> flight = SingleFlight()
+            >>> flight.do('key', max, 1, 2)
+            2
+            >>> (flight.calls, flight.shared)
+            (1, 0)
+    """
+
+    def __init__(self):
+        from threading import Lock
+
+        self._lock = Lock()
+        self._running = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func, *args):
+        from threading import Event
+
+        with self._lock:
+            self.calls += 1
+            call = self._running.get(key)
+            leader = call is None
+            if leader:
+                call = self._running[key] = {'done': Event()}
+            else:
+                self.shared += 1
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func(*args)
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            # Later callers start a new run, and see any change since this one
+            with self._lock:
+                del self._running[key]
+            call['done'].set()
+
+        return call['result']
+
+
+class BoundedExecutor:
+    """
+        BoundedExecutor(workers, size)
+            runs submitted calls on a fixed pool of worker threads.  At most
+            size calls may wait for a free worker; submitting another raises
+            queue.Full instead, so that a server can turn work away rather
+            than fall further and further behind.
+            submit returns a concurrent.futures.Future for the result.
+
+            E.g.:
+            executor = BoundedExecutor(4, 16)
+
+            try:
+                future = executor.submit(task, arg)
+            except queue.Full:
+                reply_busy()
+            ...
+            reply(future.result())
+
+            >>> executor = BoundedExecutor(1, 1)
+            >>> executor.submit(max, 1, 2).result()
+            2
+    """
+
+    def __init__(self, workers, size):
+        from queue import Queue
+        from threading import Thread
+
+        self._queue = Queue(size)
+
+        for i in range(workers):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, func, *args):
+        from concurrent.futures import Future
+
+        future = Future()
+        self._queue.put_nowait((future, func, args))
+        return future
+
+    def _work(self):
+        while True:
+            (future, func, args) = self._queue.get()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
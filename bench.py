@@ -0,0 +1,384 @@
+"""
+Usage:  bench.py workspace [options]
+        bench.py socket [options]
+        bench.py shards [options]
+        bench.py updates [options]
+
+Benchmarks for the routing code in the mapping server.
+
+Modes:
+    workspace: Runs the same random queries through the same binary heap search keeping its state in
+        fresh dicts, in a fresh SearchWorkspace and in one reused SearchWorkspace, reporting the time
+        per query and the peak memory allocated per query
+        example
+        >> bench.py workspace --graph grid-14400.txt --queries 50
+        least_cost_path, 50 queries
+                            ms/query   peak KiB/query
+        fresh dicts            26.77          1280.82
+        fresh workspace        26.92          1780.54
+        reused workspace       29.99           234.04
+
+    socket: Starts server.py in socket mode and sends it the same random queries, first with one
+        connection per request and then pipelined over a single connection, reporting requests per
+        second for each
+        example
+        >> bench.py socket --graph grid-900.txt --queries 300
+        socket mode, 300 queries
+                             requests/s
+        connect per request       373.8
+        pipelined                 673.3
+
+    shards: Splits the graph into each number of tiles in --shards, starts shard.py serve on the tiles
+        and sends it the same random queries pipelined over a single connection, reporting requests
+        per second for each number of shards
+        example
+        >> bench.py shards --graph grid-14400.txt --queries 100
+        shard.py, 100 queries
+        shards  boundary requests/s
+             1         0        9.2
+             2       240       15.7
+             4       598       17.7
+             8       948       21.5
+
+    updates: Starts server.py in socket mode and times round trips over one pipelined connection
+        for route requests searched and then taken from the route cache, against EDGE updates of
+        random edges and STREET updates of random streets, each made dearer or closed and then
+        restored
+        example
+        >> bench.py updates --graph grid-14400.txt --queries 100
+        socket mode, 100 of each
+                          ms/request
+        route, searched        30.19
+        route, cached           0.62
+        EDGE update             0.12
+        STREET update           0.72
+        EDGE closed             0.12
+        STREET closed           1.60
+
+Options:
+  --graph <GRAPHFILE>  The file to load graph info [default: edmonton-roads-2.0.1.txt]
+  --queries <N>        The number of random queries to run [default: 200]
+  --seed <SEED>        Seed for choosing the random queries [default: 1]
+  --port <PORT>        The localhost port to start the server on [default: 8090]
+  --shards <LIST>      The numbers of tiles to benchmark shard.py with [default: 1,2,4,8]
+  -h --help
+
+"""
+
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import docopt
+
+from heapq import heappush, heappop
+
+from digraph import least_cost_path, SearchWorkspace
+from geometry import project_graph
+from readgraph import readgraph
+
+
+def random_queries(G, n, seed):
+    """
+    Returns n random (start, dest) vertex pairs of G
+    """
+    rand = random.Random(seed)
+    vertices = sorted(G.vertices())
+    return [(rand.choice(vertices), rand.choice(vertices)) for i in range(n)]
+
+
+def measure(queries, route):
+    """
+    Runs route(start, dest) over every query, returning the mean time in
+    milliseconds and the mean peak of memory allocated during a query in KiB
+    """
+    # Time first with tracing off, since tracemalloc slows every allocation
+    begin = time.perf_counter()
+    for (start, dest) in queries:
+        route(start, dest)
+    elapsed = time.perf_counter() - begin
+
+    peak = 0
+    tracemalloc.start()
+    for (start, dest) in queries:
+        tracemalloc.clear_traces()
+        route(start, dest)
+        peak += tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return (elapsed * 1000 / len(queries), peak / 1024 / len(queries))
+
+
+def dict_path(G, start, dest, cost):
+    """
+    The search least_cost_path runs in a SearchWorkspace, with its distances,
+    parents and settled vertices kept in fresh dicts and a set instead, as
+    the baseline for the workspace
+    """
+    dist = {start: 0}
+    parent = {start: start}
+    done = set()
+    heap = [(0, start)]
+
+    while heap:
+        (c, cur) = heappop(heap)
+        if cur in done:
+            continue
+        done.add(cur)
+        if cur == dest:
+            break
+
+        for n in G.adj_to(cur):
+            if n in done:
+                continue
+            nc = c + cost((cur, n))
+            if n not in dist or nc < dist[n]:
+                dist[n] = nc
+                parent[n] = cur
+                heappush(heap, (nc, n))
+
+    if dest not in done:
+        return None
+
+    path = [dest]
+    while path[-1] != start:
+        path.append(parent[path[-1]])
+    path.reverse()
+    return path
+
+
+def bench_workspace(G, names, queries):
+    """
+    Compares the same heap search keeping its state in fresh dicts, in a
+    fresh SearchWorkspace for every query, and in one reused SearchWorkspace
+    """
+    cost = project_graph(G, names[0])[2].get
+    workspace = SearchWorkspace(G)
+
+    results = [
+        ("fresh dicts", measure(queries, lambda s, d: dict_path(G, s, d, cost))),
+        ("fresh workspace", measure(queries, lambda s, d: least_cost_path(G, s, d, cost, SearchWorkspace(G)))),
+        ("reused workspace", measure(queries, lambda s, d: least_cost_path(G, s, d, cost, workspace))),
+    ]
+
+    print("least_cost_path, {} queries".format(len(queries)))
+    print("{:18} {:>9} {:>16}".format("", "ms/query", "peak KiB/query"))
+    for (label, (ms, kib)) in results:
+        print("{:18} {:9.2f} {:16.2f}".format(label, ms, kib))
+
+
+
+def request_coords(names, queries):
+    """
+    Returns the (lat, long) in 100,000ths of degrees of the vertices of each
+    query
+    """
+    return [[(int(names[0][v][0] * 100000), int(names[0][v][1] * 100000)) for v in query] for query in queries]
+
+
+def start_server(graph, port, logdir):
+    """
+    Starts server.py in socket mode, returning the process once it accepts
+    connections
+    """
+    return start_process(['server.py', 'sock', '--graph', graph, '--port', str(port),
+                          '--logfile', os.path.join(logdir, 'server.log')], port)
+
+
+def start_process(args, port):
+    """
+    Starts a python script with args, returning the process once it accepts
+    connections on port
+    """
+    server = subprocess.Popen([sys.executable] + args)
+
+    while True:
+        if server.poll() is not None:
+            raise Exception("Server exited with status {}".format(server.returncode))
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+
+def connect_per_request(port, coords):
+    """
+    Sends each request on its own connection, as a python literal of degrees
+    """
+    for (p1, p2) in coords:
+        connection = socket.create_connection(('localhost', port))
+        connection.sendall(repr([[p1[0] / 100000, p1[1] / 100000], [p2[0] / 100000, p2[1] / 100000]]).encode('utf-8'))
+        while connection.recv(65536):
+            pass
+        connection.close()
+
+
+def pipelined(port, coords):
+    """
+    Sends every request over one connection with the line protocol, reading
+    the replies as they come back
+    """
+    connection = socket.create_connection(('localhost', port))
+
+    def send():
+        lines = ['ROUTE/1\n'] + ['{0[0]} {0[1]} {1[0]} {1[1]}\n'.format(p1, p2) for (p1, p2) in coords]
+        connection.sendall(''.join(lines).encode('ascii'))
+
+    # Send from another thread, so neither end blocks on a full buffer
+    sender = threading.Thread(target=send)
+    sender.start()
+
+    replies = connection.makefile('rb')
+    for i in range(len(coords) + 1):
+        replies.readline()
+
+    sender.join()
+    connection.close()
+
+
+def bench_socket(arguments, names, queries):
+    """
+    Compares requests per second of connect-per-request and pipelined socket
+    requests against a running server
+    """
+    coords = request_coords(names, queries)
+    port = int(arguments['--port'])
+
+    with tempfile.TemporaryDirectory() as logdir:
+        server = start_server(arguments['--graph'], port, logdir)
+        try:
+            results = []
+            for (label, run) in [("connect per request", connect_per_request), ("pipelined", pipelined)]:
+                begin = time.perf_counter()
+                run(port, coords)
+                results.append((label, len(coords) / (time.perf_counter() - begin)))
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+    print("socket mode, {} queries".format(len(coords)))
+    print("{:20} {:>10}".format("", "requests/s"))
+    for (label, rate) in results:
+        print("{:20} {:10.1f}".format(label, rate))
+
+
+def bench_shards(arguments, G, names, queries):
+    """
+    Compares requests per second of shard.py serving the graph split into
+    each number of tiles
+    """
+    from shard import split_graph
+
+    coords = request_coords(names, queries)
+    port = int(arguments['--port'])
+
+    results = []
+    for shards in [int(n) for n in arguments['--shards'].split(',')]:
+        with tempfile.TemporaryDirectory() as tiledir:
+            boundary = split_graph(G, names, shards, tiledir)
+            server = start_process(['shard.py', 'serve', tiledir, '--port', str(port)], port)
+            try:
+                begin = time.perf_counter()
+                pipelined(port, coords)
+                results.append((shards, boundary, len(coords) / (time.perf_counter() - begin)))
+            finally:
+                server.send_signal(signal.SIGINT)
+                server.wait()
+
+    print("shard.py, {} queries".format(len(coords)))
+    print("{:>6} {:>9} {:>10}".format("shards", "boundary", "requests/s"))
+    for (shards, boundary, rate) in results:
+        print("{:6} {:9} {:10.1f}".format(shards, boundary, rate))
+
+
+def round_trips(connection, replies, lines):
+    """
+    Sends each line and waits for its reply before sending the next,
+    returning the mean round trip in milliseconds
+    """
+    begin = time.perf_counter()
+    for line in lines:
+        connection.sendall(line.encode('ascii'))
+        replies.readline()
+
+    return (time.perf_counter() - begin) * 1000 / len(lines)
+
+
+def bench_updates(arguments, G, names, queries):
+    """
+    Compares the cost of changing edge costs on a running server against
+    the cost of route requests, searched and cached
+    """
+    coords = request_coords(names, queries)
+    port = int(arguments['--port'])
+
+    rand = random.Random(int(arguments['--seed']))
+    edges = sorted(names[1])
+    streets = sorted(set(names[1].values()))
+
+    # Every update is followed by the one restoring it, so the graph is the
+    # same after each run
+    edge_lines = []
+    street_lines = []
+    edge_closed = []
+    street_closed = []
+    for i in range(len(queries) // 2):
+        (u, v) = rand.choice(edges)
+        edge_lines.extend(['EDGE {} {} 1.5\n'.format(u, v), 'EDGE {} {} 1\n'.format(u, v)])
+        edge_closed.extend(['EDGE {} {} closed\n'.format(u, v), 'EDGE {} {} 1\n'.format(u, v)])
+        name = rand.choice(streets)
+        street_lines.extend(['STREET 1.5 {}\n'.format(name), 'STREET 1 {}\n'.format(name)])
+        street_closed.extend(['STREET closed {}\n'.format(name), 'STREET 1 {}\n'.format(name)])
+
+    route_lines = ['{0[0]} {0[1]} {1[0]} {1[1]}\n'.format(p1, p2) for (p1, p2) in coords]
+
+    with tempfile.TemporaryDirectory() as logdir:
+        server = start_server(arguments['--graph'], port, logdir)
+        try:
+            connection = socket.create_connection(('localhost', port))
+            replies = connection.makefile('rb')
+            connection.sendall(b'ROUTE/1\n')
+            replies.readline()
+
+            results = [
+                ("route, searched", round_trips(connection, replies, route_lines)),
+                ("route, cached", round_trips(connection, replies, route_lines)),
+                ("EDGE update", round_trips(connection, replies, edge_lines)),
+                ("STREET update", round_trips(connection, replies, street_lines)),
+                ("EDGE closed", round_trips(connection, replies, edge_closed)),
+                ("STREET closed", round_trips(connection, replies, street_closed)),
+            ]
+            replies.close()
+            connection.close()
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+    print("socket mode, {} of each".format(len(coords)))
+    print("{:20} {:>10}".format("", "ms/request"))
+    for (label, ms) in results:
+        print("{:20} {:10.2f}".format(label, ms))
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+
+    (G, names) = readgraph(arguments['--graph'])
+    queries = random_queries(G, int(arguments['--queries']), int(arguments['--seed']))
+
+    if arguments['workspace']:
+        bench_workspace(G, names, queries)
+    elif arguments['socket']:
+        bench_socket(arguments, names, queries)
+    elif arguments['shards']:
+        bench_shards(arguments, G, names, queries)
+    elif arguments['updates']:
+        bench_updates(arguments, G, names, queries)
@@ -14,12 +14,17 @@ Don't forget that the due date is a week away, so you can take advantage of the
 """
 
 import random
+import time
+from heapq import heappush, heappop
 
 try:
     import display
 except:
     print("Warning: failed to load display module.  Graph drawing will not work.")
 
+# Searches with a budget charge it at least every this many settled vertices
+BUDGET_CHECK = 256
+
 
 class Digraph:
     """
@@ -100,7 +105,7 @@ class Digraph:
         """
         Draws the graph into a dot file.
         """
-        display.write_dot_desc((self.vertices(), self.eges()), filename, attr)
+        display.write_dot_desc((self.vertices(), self.edges()), filename, 'digraph', attr)
 
     def num_edges(self):
         m = 0
@@ -173,6 +178,168 @@ class Digraph:
                 return False
 
 
+class SearchWorkspace:
+    """
+    Reusable scratch space for least_cost_path.
+
+    Holds the distance, parent and visited arrays of a search, indexed by a
+    dense numbering of the vertices of G, so that repeated searches do not
+    allocate and hash fresh dicts and sets.  Rather than clearing the arrays
+    between searches, every search bumps a generation counter, and an entry
+    is only valid if its stamp matches the current generation.  Resetting is
+    therefore O(1).
+
+    A workspace belongs to the graph it was built from (vertices added later
+    are unknown to it) and is not thread safe, so give every worker its own.
+    Workspaces for the same graph can share one index.
+
+    >>> G = Digraph([(1, 2), (2, 3), (3, 4), (4, 5), (1, 6), (3, 6), (6, 7)])
+    >>> W = SearchWorkspace(G)
+    >>> least_cost_path(G, 1, 7, workspace=W)
+    [1, 6, 7]
+    >>> least_cost_path(G, 7, 1, workspace=W) == None
+    True
+    >>> least_cost_path(G, 2, 5, workspace=W)
+    [2, 3, 4, 5]
+    >>> least_cost_path(G, 3, 3, workspace=W)
+    [3]
+    """
+
+    def __init__(self, G, index=None):
+        """
+        Arguments:
+            G       the graph that will be searched
+            index   an optional dict mapping each vertex of G to a distinct
+                    int in range(G.num_vertices()), to share with other
+                    workspaces
+        """
+        if index is None:
+            index = dict((v, i) for (i, v) in enumerate(G.vertices()))
+
+        self.index = index
+
+        n = len(index)
+        self.vertex = [None] * n
+        for (v, i) in index.items():
+            self.vertex[i] = v
+
+        # dist and parent of vertex i are only meaningful when
+        # seen[i] == generation, and it is settled when done[i] == generation
+        self.dist = [0] * n
+        self.parent = [0] * n
+        self.seen = [0] * n
+        self.done = [0] * n
+        self.generation = 0
+
+        self.heap = []
+
+    def reset(self):
+        """
+        Invalidates the results of the previous search, returning the new
+        generation.
+        """
+        self.generation += 1
+        del self.heap[:]
+        return self.generation
+
+    def path_to(self, dest):
+        """
+        Returns the path to dest found by the last search, starting from the
+        source it was reached from, or None if dest was not settled.
+        """
+        d = self.index[dest]
+        if self.done[d] != self.generation:
+            return None
+
+        # Sources are their own parents
+        path = [dest]
+        while self.parent[d] != d:
+            d = self.parent[d]
+            path.append(self.vertex[d])
+
+        path.reverse()
+        return path
+
+    def settled(self):
+        """
+        Returns the vertices settled by the last search.
+        """
+        generation = self.generation
+        return [self.vertex[i] for (i, g) in enumerate(self.done) if g == generation]
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised by a search that runs out of its SearchBudget.
+    """
+
+
+class SearchBudget:
+    """
+    Limits the work searches may do: at most expansions settled vertices in
+    total, and no more than seconds from when the budget was made.  Searches
+    charge their budget every BUDGET_CHECK settled vertices, or sooner once
+    fewer expansions are left, and raise BudgetExceeded once it is spent.
+    All the searches of one request can share a budget, each charging the
+    vertices it settled when it finishes.
+
+    >>> G = Digraph([(v, v + 1) for v in range(1000)])
+    >>> least_cost_path(G, 0, 10, budget=SearchBudget(expansions=300))
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    >>> least_cost_path(G, 0, 1000, budget=SearchBudget(expansions=300)) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    BudgetExceeded: search expanded more than 300 vertices
+    >>> budget = SearchBudget(expansions=100)
+    >>> len(least_cost_path(G, 0, 59, budget=budget))
+    60
+    >>> budget.left
+    40
+    >>> least_cost_path(G, 0, 40, budget=budget) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    BudgetExceeded: search expanded more than 100 vertices
+    """
+
+    def __init__(self, expansions=None, seconds=None):
+        self.expansions = expansions
+        self.left = expansions
+        self.deadline = None
+        if seconds is not None:
+            self.deadline = time.monotonic() + seconds
+
+    def spend(self, n=BUDGET_CHECK):
+        """
+        Charges n settled vertices to the budget, raising BudgetExceeded if
+        it is spent.
+        """
+        if self.left is not None:
+            self.left -= n
+            if self.left < 0:
+                raise BudgetExceeded("search expanded more than {} vertices".format(self.expansions))
+
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded("search passed its deadline")
+
+    def interval(self):
+        """
+        Returns how many vertices a search may settle before charging the
+        budget again: BUDGET_CHECK, or one more than the expansions left if
+        that is fewer, so that the search stops as soon as they are spent.
+        """
+        if self.left is None:
+            return BUDGET_CHECK
+        return min(BUDGET_CHECK, self.left + 1)
+
+    def charge(self, n):
+        """
+        Charges the n vertices a finished search settled since it last
+        charged the budget, which are never more than the expansions left.
+        """
+        if self.left is not None:
+            self.left -= n
+
+
 def random_graph(n, m):
     """
     Make a random Digraph with n vertices and m edges.
@@ -275,10 +442,124 @@ def compress(walk):
     return rv
 
 
-def least_cost_path(G, start, dest, cost=lambda a: 1):
+def strongly_connected_components(G):
+    """
+    Labels every vertex of G with the index of its strongly connected
+    component, using an iterative version of Tarjan's algorithm.
+
+    Components are numbered in reverse topological order: if a vertex in
+    component a has an edge to a vertex in component b, then b <= a.
+
+    >>> G = Digraph([(1, 2), (2, 1), (2, 3), (3, 4), (4, 3), (5, 5)])
+    >>> comp = strongly_connected_components(G)
+    >>> (comp[1] == comp[2], comp[3] == comp[4], comp[2] == comp[3])
+    (True, True, False)
+    >>> comp[3] < comp[1]
+    True
+    >>> len(set(comp.values()))
+    3
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    component = {}
+    counter = 0
+    num_components = 0
+
+    for root in G.vertices():
+        if root in index:
+            continue
+
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+
+        # Each entry of work is a vertex and the iterator over the neighbours
+        # we still have to explore, replacing the recursion of Tarjan's
+        # algorithm so long roads do not overflow the interpreter stack
+        work = [(root, iter(G.adj_to(root)))]
+
+        while work:
+            (v, children) = work[-1]
+
+            for w in children:
+                if w not in index:
+                    index[w] = lowlink[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(G.adj_to(w))))
+                    break
+                elif w in on_stack:
+                    lowlink[v] = min(lowlink[v], index[w])
+            else:
+                # All of v's neighbours are done, so pass its lowlink up to
+                # its parent and pop the component if v is its root
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    lowlink[u] = min(lowlink[u], lowlink[v])
+
+                if lowlink[v] == index[v]:
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component[w] = num_components
+                        if w == v:
+                            break
+                    num_components += 1
+
+    return component
+
+
+def component_reach(G, component):
+    """
+    Given the component labels from strongly_connected_components, returns a
+    list mapping every component to a bitset (stored in an int) of all the
+    components reachable from it, itself included.  Vertex u can reach
+    vertex v exactly when reach[component[u]] >> component[v] & 1.
+
+    >>> G = Digraph([(1, 2), (2, 1), (2, 3), (4, 3)])
+    >>> comp = strongly_connected_components(G)
+    >>> reach = component_reach(G, comp)
+    >>> bool(reach[comp[1]] >> comp[3] & 1)
+    True
+    >>> bool(reach[comp[3]] >> comp[1] & 1)
+    False
+    >>> bool(reach[comp[4]] >> comp[1] & 1)
+    False
+    """
+    num_components = max(component.values()) + 1 if component else 0
+
+    successors = [set() for c in range(num_components)]
+    for (v, w) in G.edges():
+        if component[v] != component[w]:
+            successors[component[v]].add(component[w])
+
+    # Components come out of Tarjan's algorithm in reverse topological order,
+    # so every successor of c already has its bitset by the time we get to c
+    reach = [0] * num_components
+    for c in range(num_components):
+        bits = 1 << c
+        for d in successors[c]:
+            bits |= reach[d]
+        reach[c] = bits
+
+    return reach
+
+
+def least_cost_path(G, start, dest, cost=lambda a: 1, workspace=None, budget=None):
     """
     Computes the least cost path from start to dest in a graph, assuming an
-    equal weighting if no cost function is specified
+    equal weighting if no cost function is specified.  An edge the cost
+    function gives a cost of None is closed, and is never used; the same goes
+    for every search in this module.
+
+    If a SearchWorkspace for G is given, the search runs in its preallocated
+    arrays instead of allocating new containers.  If a SearchBudget is given,
+    the search raises BudgetExceeded once it is spent.
 
     >>> G = Digraph([(1, 2), (2, 3), (3, 4), (4, 5), (1, 6), (3, 6), (6, 7)])
     >>> path = least_cost_path(G, 1, 7)
@@ -290,11 +571,20 @@ def least_cost_path(G, start, dest, cost=lambda a: 1):
     >>> path2 = least_cost_path(G2, 1, 5)
     >>> path2 == None
     True
+    >>> least_cost_path(G, 1, 7, lambda e: None if e == (1, 6) else 1)
+    [1, 2, 3, 6, 7]
     """
+    if workspace is not None:
+        route = least_cost_route(G, {start: 0}, {dest: 0}, cost, workspace, budget)
+        if route is None:
+            return None
+        return route[1]
+
     # Establish our initial variables
     todo = {start: 0}
     visited = set()
     parent = {}
+    block = ticks = budget.interval() if budget is not None else 0
 
     # Our main while loop that will terminate when the todo queue
     # is empty or the destiniation has been visited
@@ -306,19 +596,33 @@ def least_cost_path(G, start, dest, cost=lambda a: 1):
         # Mark the current place as visited
         visited.add(cur)
 
+        # Charge the budget, if there is one, every so often
+        if budget is not None:
+            ticks -= 1
+            if not ticks:
+                budget.spend(block)
+                block = ticks = budget.interval()
+
         # Itterate over the current places neibours
         for n in G.adj_to(cur):
             # If we have visited this spot before, just keep looping
             if n in visited:
                 continue
+            # An edge without a cost is closed
+            ec = cost((cur, n))
+            if ec is None:
+                continue
             # Otherwise, if this is not already in the queue, and the next
             # places cost is less than an alternate route to this place, then
             # select that new route instead because it is of a better cost
-            if n not in todo or c + cost((cur, n)) < todo[n]:
+            if n not in todo or c + ec < todo[n]:
                 # Assign the cost to the queue and save the parent
-                todo[n] = c + cost((cur, n))
+                todo[n] = c + ec
                 parent[n] = cur
 
+    if budget is not None:
+        budget.charge(block - ticks)
+
     # If we exited the while loop without getting to our destination, then
     # return None
     if dest not in visited:
@@ -339,6 +643,310 @@ def least_cost_path(G, start, dest, cost=lambda a: 1):
     return path
 
 
+def least_cost_route(G, sources, targets, cost=lambda a: 1, workspace=None, budget=None):
+    """
+    Computes the least cost path from any of several sources to any of
+    several targets.  sources maps each vertex the path may start at to the
+    cost of starting there, and targets maps each vertex it may end at to the
+    cost of finishing there.  Returns the pair (total cost, path), or None if
+    no target can be reached.
+
+    The search runs in the arrays of workspace, or of a new SearchWorkspace
+    if none is given, with a binary heap as the queue.  If a SearchBudget is
+    given, the search raises BudgetExceeded once it is spent.
+
+    >>> G = Digraph([(1, 2), (2, 3), (3, 4), (1, 5), (5, 4)])
+    >>> least_cost_route(G, {1: 0}, {4: 0})
+    (2, [1, 5, 4])
+    >>> least_cost_route(G, {1: 0, 3: 0}, {4: 0})
+    (1, [3, 4])
+    >>> least_cost_route(G, {1: 5, 3: 0}, {4: 0, 3: 4})
+    (1, [3, 4])
+    >>> least_cost_route(G, {2: 0}, {4: 5, 3: 0})
+    (1, [2, 3])
+    >>> least_cost_route(G, {4: 0}, {1: 0}) == None
+    True
+    >>> least_cost_route(G, {1: 0}, {4: 0}, lambda e: None if e == (1, 5) else 1)
+    (3, [1, 2, 3, 4])
+    """
+    return least_cost_routes(G, sources, [targets], cost, workspace, budget)[0]
+
+
+def least_cost_routes(G, sources, targets_list, cost=lambda a: 1, workspace=None, budget=None):
+    """
+    Computes the least cost routes from the same sources to each of a list
+    of target dicts with a single search, as least_cost_route does for one.
+    Returns a list with a (total cost, path) pair, or None, for each.
+
+    >>> G = Digraph([(1, 2), (2, 3), (3, 4), (1, 5), (5, 4), (6, 1)])
+    >>> least_cost_routes(G, {1: 0}, [{4: 0}, {3: 0}, {1: 0}, {6: 0}])
+    [(2, [1, 5, 4]), (2, [1, 2, 3]), (0, [1]), None]
+    >>> least_cost_routes(G, {1: 0}, [])
+    []
+    """
+    if not targets_list:
+        return []
+
+    if workspace is None:
+        workspace = SearchWorkspace(G)
+
+    gen = workspace.reset()
+    index = workspace.index
+    vertex = workspace.vertex
+    dist = workspace.dist
+    parent = workspace.parent
+    seen = workspace.seen
+    done = workspace.done
+    heap = workspace.heap
+
+    for (v, c) in sources.items():
+        i = index[v]
+        if seen[i] != gen or c < dist[i]:
+            dist[i] = c
+            parent[i] = i
+            seen[i] = gen
+            heappush(heap, (c, i))
+
+    # Which target dicts every target vertex belongs to, with the cost of
+    # finishing there
+    wanted = {}
+    for (k, targets) in enumerate(targets_list):
+        for (v, c) in targets.items():
+            wanted.setdefault(v, []).append((k, c))
+
+    best = [None] * len(targets_list)
+    best_target = [None] * len(targets_list)
+    missing = len(targets_list)
+    bound = None
+    block = ticks = budget.interval() if budget is not None else 0
+
+    # Once every target dict has a route, and the cheapest vertex in the
+    # queue costs at least as much as the dearest of them, no later target
+    # can improve on any of them
+    while heap and (bound is None or heap[0][0] < bound):
+        (c, i) = heappop(heap)
+
+        # Skip stale queue entries for vertices we already settled
+        if done[i] == gen:
+            continue
+        done[i] = gen
+
+        if budget is not None:
+            ticks -= 1
+            if not ticks:
+                budget.spend(block)
+                block = ticks = budget.interval()
+
+        cur = vertex[i]
+        if cur in wanted:
+            for (k, tc) in wanted[cur]:
+                if best[k] is None or c + tc < best[k]:
+                    if best[k] is None:
+                        missing -= 1
+                    best[k] = c + tc
+                    best_target[k] = cur
+
+            # Nothing beyond the last target needed can be cheaper
+            if not missing:
+                bound = max(best)
+                if c >= bound:
+                    continue
+
+        for n in G.adj_to(cur):
+            j = index[n]
+            if done[j] == gen:
+                continue
+
+            ec = cost((cur, n))
+            if ec is None:
+                continue
+
+            nc = c + ec
+            if seen[j] != gen or nc < dist[j]:
+                dist[j] = nc
+                parent[j] = i
+                seen[j] = gen
+                heappush(heap, (nc, j))
+
+    if budget is not None:
+        budget.charge(block - ticks)
+
+    routes = []
+    for k in range(len(targets_list)):
+        if best[k] is None:
+            routes.append(None)
+        else:
+            routes.append((best[k], workspace.path_to(best_target[k])))
+
+    return routes
+
+
+def shortest_path_tree(G, sources, cost=lambda a: 1, reverse=False, limit=None, targets=None, stretch=1, budget=None):
+    """
+    Grows a tree of least cost paths out of sources, a dict mapping each
+    start vertex to the cost of starting there.  Returns a dict mapping every
+    vertex reached to (cost, parent), where parent is the next vertex on the
+    way back to a source, or None for a source itself.
+
+    If reverse is set, the tree follows edges backwards, so that it holds
+    the least cost paths from every vertex into the sources and parent is
+    the next vertex on the way to them.  If limit is given, vertices that
+    cost more than limit are left out.  If targets is given instead (a dict
+    as for least_cost_route), the limit is stretch times the cost of the
+    least cost route to a target, found as the tree grows.  A SearchBudget
+    limits the work done as for least_cost_route.
+
+    >>> G = Digraph([(1, 2), (2, 3), (1, 3), (3, 4)])
+    >>> T = shortest_path_tree(G, {1: 0})
+    >>> [T[v] for v in [1, 2, 3, 4]]
+    [(0, None), (1, 1), (1, 1), (2, 3)]
+    >>> T = shortest_path_tree(G, {4: 0}, reverse=True, limit=1)
+    >>> sorted(T.items())
+    [(3, (1, 4)), (4, (0, None))]
+    >>> T = shortest_path_tree(G, {1: 0}, targets={2: 0}, stretch=1.5)
+    >>> sorted(T)
+    [1, 2, 3]
+    >>> T = shortest_path_tree(Digraph([(1, 2)]), {1: 0, 2: 5}, lambda e: 5)
+    >>> T[2]
+    (5, None)
+    """
+    tree = {}
+    best = None
+    block = ticks = budget.interval() if budget is not None else 0
+
+    # Entries are (cost, vertex, 0, None) for a source and (cost, vertex, 1,
+    # parent) otherwise, so that a source reached again at the same cost
+    # wins the tie without comparing None to a vertex
+    todo = [(c, v, 0, None) for (v, c) in sources.items()]
+    todo.sort()
+
+    while todo:
+        (c, cur, k, p) = heappop(todo)
+        if cur in tree:
+            continue
+        if limit is not None and c > limit:
+            break
+
+        tree[cur] = (c, p)
+
+        if budget is not None:
+            ticks -= 1
+            if not ticks:
+                budget.spend(block)
+                block = ticks = budget.interval()
+
+        if targets is not None and cur in targets and (best is None or c + targets[cur] < best):
+            best = c + targets[cur]
+            limit = best * stretch
+
+        if reverse:
+            for n in G.adj_from(cur):
+                if n not in tree:
+                    ec = cost((n, cur))
+                    if ec is not None:
+                        heappush(todo, (c + ec, n, 1, cur))
+        else:
+            for n in G.adj_to(cur):
+                if n not in tree:
+                    ec = cost((cur, n))
+                    if ec is not None:
+                        heappush(todo, (c + ec, n, 1, cur))
+
+    if budget is not None:
+        budget.charge(block - ticks)
+
+    return tree
+
+
+def alternative_paths(G, sources, targets, cost=lambda a: 1, k=3, max_stretch=1.25, max_overlap=0.75, budget=None):
+    """
+    Finds up to k least cost paths from sources to targets (as for
+    least_cost_route) that are reasonable alternatives to each other.
+    Returns a list of (cost, path) pairs, cheapest first, or an empty list if
+    no target can be reached.
+
+    Candidates come from the via vertex method: a forward tree out of the
+    sources and a backward tree into the targets are grown once, and every
+    vertex v both reach gives the path through v.  A candidate is kept if it
+    costs at most max_stretch times the best path, and at most max_overlap
+    of its cost is on edges of paths already chosen.  Both trees share the
+    SearchBudget, if one is given.
+
+    >>> G = Digraph([(1, 2), (2, 5), (1, 3), (3, 5), (1, 4), (4, 5), (2, 3)])
+    >>> cost = lambda e: {(1, 4): 3, (4, 5): 3}.get(e, 2)
+    >>> alternative_paths(G, {1: 0}, {5: 0}, cost)
+    [(4, [1, 2, 5]), (4, [1, 3, 5])]
+    >>> alternative_paths(G, {1: 0}, {5: 0}, cost, max_stretch=2)
+    [(4, [1, 2, 5]), (4, [1, 3, 5]), (6, [1, 4, 5])]
+    >>> alternative_paths(G, {1: 0}, {5: 0}, cost, k=1)
+    [(4, [1, 2, 5])]
+    >>> alternative_paths(G, {5: 0}, {1: 0}, cost)
+    []
+    """
+    # Both trees only need to reach as far as the longest allowed path, and
+    # are shared by every candidate.  The forward tree finds the best path on
+    # the way.
+    forward = shortest_path_tree(G, sources, cost, targets=targets, stretch=max_stretch, budget=budget)
+
+    reached = [(forward[t][0] + targets[t], t) for t in targets if t in forward]
+    if not reached:
+        return []
+    (c, t) = min(reached)
+
+    path = [t]
+    while forward[path[-1]][1] is not None:
+        path.append(forward[path[-1]][1])
+    path.reverse()
+    best = (c, path)
+
+    limit = c * max_stretch
+    backward = shortest_path_tree(G, targets, cost, reverse=True, limit=limit, budget=budget)
+
+    chosen = [best]
+    used = set(best[1])
+    shared = set(zip(best[1], best[1][1:]))
+
+    candidates = [(forward[v][0] + backward[v][0], v) for v in forward if v in backward]
+    candidates.sort()
+
+    for (c, v) in candidates:
+        if len(chosen) >= k or c > limit:
+            break
+
+        # A vertex on a chosen path leads back to (part of) that path
+        if v in used:
+            continue
+
+        path = [v]
+        while forward[path[-1]][1] is not None:
+            path.append(forward[path[-1]][1])
+        path.reverse()
+        while backward[path[-1]][1] is not None:
+            path.append(backward[path[-1]][1])
+        path = compress(path)
+
+        # Removing a cycle can only make the path cheaper
+        edges = list(zip(path, path[1:]))
+        costs = [cost(e) for e in edges]
+
+        # An edge closed since the trees were grown rules the path out
+        if None in costs:
+            continue
+        c = sources[path[0]] + sum(costs) + targets[path[-1]]
+        overlap = sum(ec for (e, ec) in zip(edges, costs) if e in shared)
+
+        # Vertices of a rejected path mostly lead to the same path again, so
+        # they are not worth trying either
+        used.update(path)
+        if overlap > max_overlap * c:
+            continue
+
+        chosen.append((c, path))
+        shared.update(edges)
+
+    return chosen
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -35,8 +35,21 @@ Each of these keys maps to a dictionary.
     atrributes['edge_label'][(e,v)] if present is a string
         that will be used as the label for egde (u,v).  If
         not present, the dge is unlabelled. 
-    
+    atrributes['edge_width'][(u,v)] if present is the pen
+        width of edge (u, v), instead of 3.
+    atrributes['vertex_pos'][v] if present is the (x, y)
+        position of vertex v.  If vertex_pos is given at all,
+        vertices are drawn as points at their positions, for
+        rendering with neato -n.
+
+The dot description is written a line at a time to a file,
+so that graphs of a whole city can be written in linear time.
+For a road graph, box_subgraph takes only the part inside a
+box of (lat, long), route_box gives the box around a route,
+and search_attributes highlights a route and the vertices a
+search settled.
 """
+import io
 import time
 import sys
 
@@ -47,27 +60,43 @@ def gen_dot_desc(G, graphtype='graph', attributes={}):
 
     >>> g = ({1, 2, 3}, {(1, 2), (1, 3)} )
     >>> s = gen_dot_desc(g)
- 
+    >>> print(gen_dot_desc(({1, 2}, {(1, 2)}), 'digraph'))
+    digraph g {
+      ordering=out;
+      node [shape=circle];
+      edge [penwidth=3];
+      1 [label="1", style=filled, fillcolor="white"];
+      2 [label="2", style=filled, fillcolor="white"];
+      1 -> 2 [color="black" ];
+    }
+    <BLANKLINE>
     """
-    if "vertex_color" in attributes:
-        vertex_color=attributes["vertex_color"]
-    else:
-        vertex_color={ }
-
-    if "edge_color" in attributes:
-        edge_color=attributes["edge_color"]
-    else:
-        edge_color={ }
+    f = io.StringIO()
+    write_dot(f, G, graphtype, attributes)
+    return f.getvalue()
 
-    if "vertex_label" in attributes:
-        vertex_label=attributes["vertex_label"]
-    else:
-        vertex_label={ }
+def write_dot(f, G, graphtype='graph', attributes={}):
+    """
+    Given graph G, write the dot description of G to
+    the file object f, a line at a time.
 
-    if "edge_label" in attributes:
-        edge_label=attributes["edge_label"]
-    else:
-        edge_label={ }
+    >>> write_dot(sys.stdout, ({1, 2}, {(1, 2)}), 'digraph',
+    ...     {'vertex_pos': {1: (0, 0), 2: (3, 4)}, 'edge_width': {(1, 2): 6}})
+    digraph g {
+      ordering=out;
+      node [shape=point, width=0.05];
+      edge [penwidth=3];
+      1 [label="1", style=filled, fillcolor="white", pos="0,0!"];
+      2 [label="2", style=filled, fillcolor="white", pos="3,4!"];
+      1 -> 2 [color="black" , penwidth=6];
+    }
+    """
+    vertex_color = attributes.get("vertex_color", { })
+    edge_color = attributes.get("edge_color", { })
+    vertex_label = attributes.get("vertex_label", { })
+    edge_label = attributes.get("edge_label", { })
+    edge_width = attributes.get("edge_width", { })
+    vertex_pos = attributes.get("vertex_pos")
 
     (V, E) = G
 
@@ -77,46 +106,43 @@ def gen_dot_desc(G, graphtype='graph', attributes={}):
         edgesym = "->"
 
     # generate the header
-    dot_desc = ( graphtype + 
-        " g {\n" + 
-        "  ordering=out;\n" +
-        "  node [shape=circle];\n" +
-        "  edge [penwidth=3];\n" 
-        )
+    shape = "circle"
+    if vertex_pos is not None:
+        shape = "point, width=0.05"
+    f.write(graphtype + " g {\n")
+    f.write("  ordering=out;\n")
+    f.write("  node [shape={}];\n".format(shape))
+    f.write("  edge [penwidth=3];\n")
 
     # now generate vertex and edges information
     if len(V) == 0:
-       dot_desc += "Empty [shape=ellipse];\n"
+        f.write("Empty [shape=ellipse];\n")
     else:
         for n in V:
-            color = "white"
-            if n in vertex_color: 
-                color = vertex_color[n]
+            color = vertex_color.get(n, "white")
+            label = vertex_label.get(n, str(n))
 
-            label = str(n)
-            if n in vertex_label: 
-                label = vertex_label[n]
+            pos = ""
+            if vertex_pos is not None and n in vertex_pos:
+                pos = ', pos="{0[0]},{0[1]}!"'.format(vertex_pos[n])
 
-            dot_desc += '  {v} [label="{l}", style=filled, fillcolor="{c}"];\n'.format(
-                v=str(n), l=label, c=color)
+            f.write('  {v} [label="{l}", style=filled, fillcolor="{c}"{p}];\n'.format(
+                v=str(n), l=label, c=color, p=pos))
 
         for e in E:
             (x, y) = e
-            color = "black"
-            if e in edge_color: 
-                color = edge_color[e]
+            color = edge_color.get(e, "black")
             label = ""
             if e in edge_label:
                 label = ', label="{}"'.format(edge_label[e])
+            if e in edge_width:
+                label += ', penwidth={}'.format(edge_width[e])
 
-            dot_desc += '  {vx} {esym} {vy} [color="{c}" {l}];\n'.format(
-                    esym=edgesym, vx=str(x), vy=str(y), c=color, l=label)
-
+            f.write('  {vx} {esym} {vy} [color="{c}" {l}];\n'.format(
+                    esym=edgesym, vx=str(x), vy=str(y), c=color, l=label))
 
     # close off the description
-    dot_desc += "}\n"
-
-    return dot_desc
+    f.write("}\n")
 
 def write_dot_desc(G, file_name, graphtype='graph', attributes={}):
     """
@@ -131,7 +157,85 @@ def write_dot_desc(G, file_name, graphtype='graph', attributes={}):
     # http://docs.python.org/3.2/tutorial/inputoutput.html
 
     with open(file_name, 'w') as f:
-        f.write( gen_dot_desc(G, graphtype, attributes) )
+        write_dot(f, G, graphtype, attributes)
+
+def box_subgraph(G, coords, box):
+    """
+    Given a Digraph G and the (lat, long) of its vertices,
+    return the (V, E) of the part of G inside box, given as
+    (lat0, long0, lat1, long1) of two opposite corners.
+    Edges are kept if both of their ends are inside.
+
+    >>> from digraph import Digraph
+    >>> G = Digraph([(1, 2), (2, 3)])
+    >>> coords = {1: (53.50, -113.50), 2: (53.51, -113.50), 3: (53.60, -113.50)}
+    >>> (V, E) = box_subgraph(G, coords, (53.55, -113.45, 53.45, -113.55))
+    >>> (sorted(V), sorted(E))
+    ([1, 2], [(1, 2)])
+    """
+    (lat0, long0, lat1, long1) = box
+    (lat0, lat1) = (min(lat0, lat1), max(lat0, lat1))
+    (long0, long1) = (min(long0, long1), max(long0, long1))
+
+    V = set()
+    for v in G.vertices():
+        (lat, long) = coords[v]
+        if lat0 <= lat <= lat1 and long0 <= long <= long1:
+            V.add(v)
+
+    E = set()
+    for v in V:
+        for w in G.adj_to(v):
+            if w in V:
+                E.add((v, w))
+
+    return (V, E)
+
+def route_box(coords, path, margin=0.005):
+    """
+    Given the (lat, long) of vertices, return the box around
+    the vertices of path, widened by margin degrees on each
+    side, for box_subgraph.
+
+    >>> route_box({1: (53.5, -113.5), 2: (53.6, -113.4)}, [1, 2], 0.01)
+    (53.49, -113.51, 53.61, -113.39)
+    """
+    lats = [coords[v][0] for v in path]
+    longs = [coords[v][1] for v in path]
+
+    return (min(lats) - margin, min(longs) - margin,
+            max(lats) + margin, max(longs) + margin)
+
+def search_attributes(coords, path=(), settled=(), scale=10000):
+    """
+    Given the (lat, long) of the vertices to draw, return
+    attributes that draw each vertex at its position, with
+    the vertices in settled (the ones a search settled) light
+    blue and path in thick red, for write_dot.  Positions are
+    in points from the south west corner, scale points to a
+    degree.
+
+    >>> a = search_attributes({1: (53.5, -113.5), 2: (53.501, -113.5)}, [1, 2], [1, 2])
+    >>> (a['vertex_pos'][2], a['vertex_color'][2], a['edge_color'][(1, 2)])
+    ((0, 10), 'red', 'red')
+    """
+    south = min([lat for (lat, long) in coords.values()] or [0])
+    west = min([long for (lat, long) in coords.values()] or [0])
+
+    # Longitude runs across the picture and latitude up it
+    vertex_pos = dict((v, (int(round((long - west) * scale)), int(round((lat - south) * scale))))
+        for (v, (lat, long)) in coords.items())
+
+    vertex_color = dict((v, "lightblue") for v in settled)
+    for v in path:
+        vertex_color[v] = "red"
+
+    route = list(zip(path, path[1:]))
+    edge_color = dict((e, "red") for e in route)
+    edge_width = dict((e, 8) for e in route)
+
+    return {'vertex_pos': vertex_pos, 'vertex_color': vertex_color,
+        'edge_color': edge_color, 'edge_width': edge_width}
 
 def pause(time=1,prompt="next?"):
     """
@@ -0,0 +1,276 @@
+"""
+Planar geometry for the street digraph.
+
+Vertex coordinates are (lat, long) in degrees.  Measuring with them directly
+is wrong, since at Edmonton's latitude a degree of longitude is only about
+0.6 of a degree of latitude on the ground.  So at load time every coordinate
+is projected onto a local plane about the centre of the graph using an
+equirectangular projection, where x runs east and y runs north, and both are
+integer decimetres.  Over a city the error of the projection is far smaller
+than the resolution of the road data.
+
+>>> P = Projection([(53.5, -113.5), (53.6, -113.4)])
+>>> P.project((53.55, -113.45))
+(0, 0)
+>>> distance(P.project((53.5, -113.45)), P.project((53.6, -113.45)))
+111194
+>>> distance(P.project((53.55, -113.5)), P.project((53.55, -113.4)))
+66064
+"""
+
+import math
+
+# Mean radius of the earth, in decimetres
+EARTH_RADIUS = 63710000
+
+
+class Projection:
+    """
+    Equirectangular projection of (lat, long) in degrees to integer
+    decimetres on a plane centred on a set of coordinates.
+    """
+
+    def __init__(self, coords):
+        """
+        Arguments:
+            coords  the (lat, long) coordinates to centre the projection on
+        """
+        lats = []
+        longs = []
+        for (lat, long) in coords:
+            lats.append(lat)
+            longs.append(long)
+
+        if lats:
+            self.origin = ((min(lats) + max(lats)) / 2, (min(longs) + max(longs)) / 2)
+        else:
+            self.origin = (0.0, 0.0)
+
+        # Decimetres per degree north, and per degree east at the centre
+        self.scale_y = EARTH_RADIUS * math.pi / 180
+        self.scale_x = self.scale_y * math.cos(math.radians(self.origin[0]))
+
+    def project(self, coord):
+        """
+        Returns the (x, y) point in decimetres of a (lat, long) coordinate.
+        """
+        return (int(round((coord[1] - self.origin[1]) * self.scale_x)),
+                int(round((coord[0] - self.origin[0]) * self.scale_y)))
+
+    def unproject(self, point):
+        """
+        Returns the (lat, long) coordinate of an (x, y) point.
+
+        >>> P = Projection([(53.5, -113.5), (53.6, -113.4)])
+        >>> (lat, long) = P.unproject(P.project((53.52, -113.49)))
+        >>> (round(lat, 5), round(long, 5))
+        (53.52, -113.49)
+        """
+        return (point[1] / self.scale_y + self.origin[0],
+                point[0] / self.scale_x + self.origin[1])
+
+
+def distance(p, q):
+    """
+    Returns the distance between two projected points, rounded to an int.
+
+    >>> distance((0, 0), (3, 4))
+    5
+    """
+    return int(round(math.hypot(q[0] - p[0], q[1] - p[1])))
+
+
+def distance2(p, q):
+    """
+    Returns the squared distance between two projected points, which orders
+    points the same as distance without taking a square root.
+
+    >>> distance2((0, 0), (3, 4))
+    25
+    """
+    dx = q[0] - p[0]
+    dy = q[1] - p[1]
+    return dx * dx + dy * dy
+
+
+
+def project_graph(G, coords):
+    """
+    Projects a street digraph, given the (lat, long) of each vertex.  Returns
+    the Projection, a dict of the (x, y) point of each vertex, and a dict of
+    the length of each edge.
+
+    >>> from digraph import Digraph
+    >>> G = Digraph([(1, 2), (2, 1)])
+    >>> (P, xy, lengths) = project_graph(G, {1: (53.5, -113.5), 2: (53.5001, -113.5)})
+    >>> (lengths[(1, 2)], lengths[(2, 1)])
+    (112, 112)
+    """
+    projection = Projection(coords.values())
+    xy = dict((v, projection.project(coord)) for (v, coord) in coords.items())
+    lengths = dict((e, distance(xy[e[0]], xy[e[1]])) for e in G.edges())
+
+    return (projection, xy, lengths)
+
+
+def segment_distance2(point, p, q):
+    """
+    Returns (d2, t) where d2 is the squared distance from point to the
+    segment from p to q, and t is the fraction of the way from p to q of the
+    closest point of the segment.
+
+    >>> segment_distance2((5, 3), (0, 0), (10, 0))
+    (9.0, 0.5)
+    >>> segment_distance2((-3, 4), (0, 0), (10, 0))
+    (25.0, 0.0)
+    >>> segment_distance2((1, 1), (2, 2), (2, 2))
+    (2.0, 0.0)
+    """
+    dx = q[0] - p[0]
+    dy = q[1] - p[1]
+    length2 = dx * dx + dy * dy
+
+    t = 0.0
+    if length2 > 0:
+        t = ((point[0] - p[0]) * dx + (point[1] - p[1]) * dy) / length2
+        t = min(1.0, max(0.0, t))
+
+    ex = p[0] + t * dx - point[0]
+    ey = p[1] + t * dy - point[1]
+    return (ex * ex + ey * ey, t)
+
+
+class SegmentIndex:
+    """
+    Spatial index of line segments in grid buckets, for finding the segment
+    nearest to a point without looking at every segment.
+
+    Each segment is stored in every cell its bounding box covers.  A query
+    looks at rings of cells around the point, stopping once the closest
+    segment found is nearer than anything outside the rings can be.  A point
+    can be indexed as a segment from itself to itself.
+
+    >>> I = SegmentIndex([('a', (0, 0), (10, 0)), ('b', (0, 5), (0, 20))], cell=4)
+    >>> I.nearest((6, 2))
+    (4.0, 'a', 0.6)
+    >>> I.nearest((-2, 30))
+    (104.0, 'b', 1.0)
+    >>> SegmentIndex([]).nearest((0, 0)) == None
+    True
+    """
+
+    def __init__(self, segments=(), cell=2000):
+        """
+        Arguments:
+            segments    an iterable of (key, p, q) triples, where p and q are
+                        the projected end points of the segment named key
+            cell        the width of a grid cell, in the units of the points
+        """
+        self.cell = cell
+        self.buckets = {}
+        self.bounds = None
+
+        for (key, p, q) in segments:
+            self.add(key, p, q)
+
+    def _cell(self, point):
+        return (int(point[0] // self.cell), int(point[1] // self.cell))
+
+    def add(self, key, p, q):
+        """
+        Adds the segment from p to q, named key, to the index.
+        """
+        (x0, y0) = self._cell((min(p[0], q[0]), min(p[1], q[1])))
+        (x1, y1) = self._cell((max(p[0], q[0]), max(p[1], q[1])))
+
+        segment = (key, p, q)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                self.buckets.setdefault((x, y), []).append(segment)
+
+        if self.bounds is None:
+            self.bounds = (x0, y0, x1, y1)
+        else:
+            self.bounds = (min(x0, self.bounds[0]), min(y0, self.bounds[1]),
+                           max(x1, self.bounds[2]), max(y1, self.bounds[3]))
+
+    def remove(self, key, p, q):
+        """
+        Removes the segment from p to q named key, as it was added.  The
+        bounds of the index are left as they were, which only costs a query
+        a few empty rings.
+
+        >>> I = SegmentIndex([('a', (0, 0), (10, 0)), ('b', (0, 5), (0, 20))], cell=4)
+        >>> I.remove('a', (0, 0), (10, 0))
+        >>> I.nearest((6, 2))
+        (45.0, 'b', 0.0)
+        """
+        (x0, y0) = self._cell((min(p[0], q[0]), min(p[1], q[1])))
+        (x1, y1) = self._cell((max(p[0], q[0]), max(p[1], q[1])))
+
+        segment = (key, p, q)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                bucket = self.buckets[(x, y)]
+                bucket.remove(segment)
+                if not bucket:
+                    del self.buckets[(x, y)]
+
+    def _ring(self, cx, cy, r):
+        """
+        Generates the occupied cells r cells away from (cx, cy) in the
+        maximum norm, clipped to the bounds of the index.
+        """
+        (bx0, by0, bx1, by1) = self.bounds
+        x0 = max(cx - r, bx0)
+        x1 = min(cx + r, bx1)
+
+        for y in (cy - r, cy + r):
+            if by0 <= y <= by1:
+                for x in range(x0, x1 + 1):
+                    if (x, y) in self.buckets:
+                        yield (x, y)
+            if r == 0:
+                return
+
+        for x in (cx - r, cx + r):
+            if bx0 <= x <= bx1:
+                for y in range(max(cy - r + 1, by0), min(cy + r - 1, by1) + 1):
+                    if (x, y) in self.buckets:
+                        yield (x, y)
+
+    def nearest(self, point):
+        """
+        Returns (d2, key, t) for the segment nearest to point, where d2 is the
+        squared distance to it and t is the fraction of the way along it of
+        the closest point, or None if the index is empty.
+        """
+        if self.bounds is None:
+            return None
+
+        (cx, cy) = self._cell(point)
+        (bx0, by0, bx1, by1) = self.bounds
+
+        # Rings that do not reach the bounds of the index are empty, and once
+        # a ring covers the bounds there is nothing further out
+        r = max(bx0 - cx, cx - bx1, by0 - cy, cy - by1, 0)
+        last = max(cx - bx0, bx1 - cx, cy - by0, by1 - cy)
+
+        best = None
+        while True:
+            for cell in self._ring(cx, cy, r):
+                for (key, p, q) in self.buckets[cell]:
+                    (d2, t) = segment_distance2(point, p, q)
+                    if best is None or d2 < best[0]:
+                        best = (d2, key, t)
+
+            # A segment not seen yet is only in cells outside ring r, which
+            # are at least r cells away from the point
+            if r >= last or (best is not None and best[0] <= (r * self.cell) ** 2):
+                return best
+
+            r += 1
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
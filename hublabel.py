@@ -0,0 +1,355 @@
+"""
+Usage:  hublabel.py build <labelfile> [options]
+        hublabel.py query <labelfile> <start> <dest> [options]
+
+Hub labels (2-hop labels) of the street digraph, for answering the cost of
+the least cost path between two vertices without a search.
+
+Every vertex v gets an out label, of (hub, cost from v to the hub) pairs, and
+an in label, of (hub, cost from the hub to v) pairs, chosen so that some
+least cost path from u to v passes through a hub in both the out label of u
+and the in label of v.  The cost from u to v is then the least sum over the
+hubs the two labels share, found by merging them.
+
+Labels are built offline by pruned landmark labeling, and written as flat
+sorted arrays that HubLabels reads through mmap, so a server opening the file
+only pages in the labels it uses.
+
+Modes:
+    build: Builds the labels of --graph and writes them to <labelfile>
+        example
+        >> hublabel.py build labels.bin --box 53.45,-113.60,53.60,-113.40
+        labelled 2552 of 14403 vertices, 208.7 hubs per label
+
+    query: Prints the cost of the least cost path from vertex <start> to vertex <dest>
+        example
+        >> hublabel.py query labels.bin 1000 7044
+        186307
+
+Options:
+  --graph <GRAPHFILE>  The file to load graph info [default: edmonton-roads-2.0.1.txt]
+  --box <BOX>          Only write the labels of vertices inside lat0,long0,lat1,long1
+  --samples <N>        How many search trees to sample to order the hubs [default: 16]
+  -h --help
+
+"""
+
+import mmap
+import random
+import struct
+import zlib
+from array import array
+from bisect import bisect_left
+from heapq import heappush, heappop
+
+from digraph import least_cost_path, shortest_path_tree
+
+# The file starts with the magic, the format version, the number of vertices
+# labelled, the number of hubs in all of their out labels and in labels, and
+# the fingerprint of the graph the labels were built from
+MAGIC = b'HUBL'
+HEADER = struct.Struct('=4sIqqqI4x')
+
+# Vertex ids and label offsets are stored as 'q', and hub ranks and costs as
+# 'i', in native byte order
+ID_TYPE = 'q'
+LABEL_TYPE = 'i'
+
+
+def graph_fingerprint(G, cost):
+    """
+    Returns a checksum of the edges of G and their costs, to tell whether
+    labels were built from the same graph.
+
+    >>> from digraph import Digraph
+    >>> G = Digraph([(1, 2), (2, 1)])
+    >>> graph_fingerprint(G, lambda e: 1) == graph_fingerprint(G, lambda e: 2)
+    False
+    """
+    checksum = 0
+    for e in sorted(G.edges()):
+        checksum = zlib.crc32('{} {} {}\n'.format(e[0], e[1], cost(e)).encode('ascii'), checksum)
+
+    return checksum
+
+
+def hub_order(G, cost, samples=16, seed=1):
+    """
+    Returns the vertices of G, most important hub first.
+
+    A vertex is important if many least cost paths pass through it, which is
+    estimated by growing search trees out of a sample of random vertices and
+    counting the vertices below each vertex in them.  Ties go to the vertex
+    with more edges.
+
+    >>> from digraph import Digraph
+    >>> G = Digraph([(1, 2), (2, 1), (2, 3), (3, 2), (2, 4), (4, 2)])
+    >>> hub_order(G, lambda e: 1)[0]
+    2
+    """
+    vertices = sorted(G.vertices())
+    rand = random.Random(seed)
+
+    below = dict((v, 0) for v in vertices)
+    for i in range(min(samples, len(vertices))):
+        root = rand.choice(vertices)
+        for reverse in (False, True):
+            tree = shortest_path_tree(G, {root: 0}, cost, reverse=reverse)
+
+            # Deepest first, so that every vertex is counted before its parent
+            size = dict((v, 1) for v in tree)
+            for v in sorted(tree, key=lambda v: tree[v][0], reverse=True):
+                p = tree[v][1]
+                if p is not None:
+                    size[p] += size[v]
+                below[v] += size[v]
+
+    return sorted(vertices, key=lambda v: (-below[v], -len(G.adj_to(v)) - len(G.adj_from(v)), v))
+
+
+def _covered(label, hubs, limit):
+    """
+    Returns True if label, a list of (rank, cost) pairs, shares a hub with
+    the dict hubs of rank to cost at a total cost of at most limit.
+    """
+    for (r, c) in label:
+        d = hubs.get(r)
+        if d is not None and c + d <= limit:
+            return True
+
+    return False
+
+
+def build_labels(G, cost, order):
+    """
+    Builds the out and in labels of every vertex of G by pruned landmark
+    labeling, taking the vertices as hubs in the given order.  Returns a pair
+    of dicts mapping each vertex to its out label and its in label, lists of
+    (rank, cost) pairs sorted by rank, where rank is the position of the hub
+    in order.
+
+    From each hub in turn a search runs forwards, adding the hub to the in
+    label of every vertex it settles, and one runs backwards adding it to out
+    labels.  A search does not continue through a vertex the labels so far
+    already cover at no more cost, which keeps labels small.
+
+    >>> from digraph import Digraph
+    >>> G = Digraph([(1, 2), (2, 3), (3, 1)])
+    >>> (out, into) = build_labels(G, lambda e: 1, [2, 1, 3])
+    >>> (out[3], into[3])
+    ([(0, 2), (1, 1), (2, 0)], [(0, 1), (2, 0)])
+    """
+    out = dict((v, []) for v in G.vertices())
+    into = dict((v, []) for v in G.vertices())
+
+    for (rank, hub) in enumerate(order):
+        for (labels, others, step, edge) in ((into, out, G.adj_to, lambda a, b: (a, b)),
+                                             (out, into, G.adj_from, lambda a, b: (b, a))):
+            hubs = dict(others[hub])
+            settled = set()
+            todo = [(0, hub)]
+
+            while todo:
+                (c, v) = heappop(todo)
+                if v in settled:
+                    continue
+                settled.add(v)
+
+                if _covered(labels[v], hubs, c):
+                    continue
+                labels[v].append((rank, c))
+
+                for n in step(v):
+                    if n not in settled:
+                        heappush(todo, (c + cost(edge(v, n)), n))
+
+    return (out, into)
+
+
+def write_labels(filename, out, into, fingerprint, vertices=None):
+    """
+    Writes labels from build_labels to filename, for the given vertices or
+    for every vertex.
+    """
+    ids = array(ID_TYPE, sorted(out if vertices is None else vertices))
+
+    arrays = [ids]
+    for labels in (out, into):
+        offsets = array(ID_TYPE, [0])
+        ranks = array(LABEL_TYPE)
+        costs = array(LABEL_TYPE)
+        for v in ids:
+            for (r, c) in labels[v]:
+                ranks.append(r)
+                costs.append(c)
+            offsets.append(len(ranks))
+        arrays.extend([offsets, ranks, costs])
+
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 1, len(ids), len(arrays[2]), len(arrays[5]), fingerprint))
+        for a in arrays:
+            a.tofile(f)
+
+
+class HubLabels:
+    """
+    Hub labels written by write_labels, read through mmap.
+
+    >>> import os, tempfile
+    >>> from digraph import Digraph
+    >>> G = Digraph([(1, 2), (2, 3), (3, 1), (3, 4)])
+    >>> (out, into) = build_labels(G, lambda e: 1, hub_order(G, lambda e: 1))
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'labels.bin')
+    >>> write_labels(filename, out, into, 0, [1, 2, 3])
+    >>> H = HubLabels(filename)
+    >>> (H.cost(1, 3), H.cost(3, 2), H.cost(2, 2))
+    (2, 2, 0)
+    >>> (1 in H, 4 in H)
+    (True, False)
+    >>> H.path(G, 3, 2)
+    [3, 1, 2]
+    >>> H.close()
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, n, n_out, n_in, self.fingerprint) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != 1:
+            raise ValueError("{} is not a hub label file".format(filename))
+
+        view = memoryview(self.map)
+        position = HEADER.size
+
+        def take(typecode, length):
+            nonlocal position
+            end = position + length * array(typecode).itemsize
+            a = view[position:end].cast(typecode)
+            position = end
+            return a
+
+        self.ids = take(ID_TYPE, n)
+        self.out_offsets = take(ID_TYPE, n + 1)
+        self.out_ranks = take(LABEL_TYPE, n_out)
+        self.out_costs = take(LABEL_TYPE, n_out)
+        self.in_offsets = take(ID_TYPE, n + 1)
+        self.in_ranks = take(LABEL_TYPE, n_in)
+        self.in_costs = take(LABEL_TYPE, n_in)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, v):
+        i = bisect_left(self.ids, v)
+        return i < len(self.ids) and self.ids[i] == v
+
+    def _position(self, v):
+        i = bisect_left(self.ids, v)
+        if i == len(self.ids) or self.ids[i] != v:
+            raise KeyError(v)
+        return i
+
+    def cost(self, start, dest):
+        """
+        Returns the cost of the least cost path from start to dest, or None
+        if there is no path.  Raises KeyError if either vertex has no labels.
+        """
+        a = self._position(start)
+        b = self._position(dest)
+
+        (i, i_end) = (self.out_offsets[a], self.out_offsets[a + 1])
+        (j, j_end) = (self.in_offsets[b], self.in_offsets[b + 1])
+        (out_ranks, in_ranks) = (self.out_ranks, self.in_ranks)
+
+        # Both labels are sorted by rank, so shared hubs line up in one pass
+        best = None
+        while i < i_end and j < j_end:
+            r = out_ranks[i]
+            s = in_ranks[j]
+            if r == s:
+                c = self.out_costs[i] + self.in_costs[j]
+                if best is None or c < best:
+                    best = c
+                i += 1
+                j += 1
+            elif r < s:
+                i += 1
+            else:
+                j += 1
+
+        return best
+
+    def path(self, G, start, dest, cost=lambda e: 1, workspace=None, budget=None):
+        """
+        Returns the least cost path from start to dest as least_cost_path
+        does, which the labels do not store.  The search is skipped when the
+        labels show there is no path.
+        """
+        if start in self and dest in self and self.cost(start, dest) is None:
+            return None
+
+        return least_cost_path(G, start, dest, cost, workspace, budget)
+
+    def close(self):
+        """
+        Unmaps the file.  The labels cannot be used afterwards.
+        """
+        for name in ('ids', 'out_offsets', 'out_ranks', 'out_costs', 'in_offsets', 'in_ranks', 'in_costs'):
+            getattr(self, name).release()
+        self.map.close()
+        self.file.close()
+
+    def __del__(self):
+        # Labels dropped without close(), such as by a server replaced by a
+        # reload once its last request finishes, are closed when collected
+        if hasattr(self, 'in_costs') and not self.map.closed:
+            self.close()
+
+
+def box_vertices(coords, box):
+    """
+    Returns the vertices whose (lat, long) in coords is inside box, given as
+    the string lat0,long0,lat1,long1 of two opposite corners.
+
+    >>> sorted(box_vertices({1: (53.5, -113.5), 2: (53.7, -113.5)}, '53.4,-113.6,53.6,-113.4'))
+    [1]
+    """
+    (lat0, long0, lat1, long1) = [float(x) for x in box.split(',')]
+    (lat0, lat1) = (min(lat0, lat1), max(lat0, lat1))
+    (long0, long1) = (min(long0, long1), max(long0, long1))
+
+    return [v for (v, (lat, long)) in coords.items() if lat0 <= lat <= lat1 and long0 <= long <= long1]
+
+
+if __name__ == '__main__':
+    import docopt
+
+    from geometry import project_graph
+    from readgraph import readgraph
+
+    arguments = docopt.docopt(__doc__)
+
+    if arguments['build']:
+        (G, names) = readgraph(arguments['--graph'])
+        cost = project_graph(G, names[0])[2].get
+
+        # Labels of vertices outside the box are still built, since searches
+        # from hubs inside it are pruned by them, but are not written
+        vertices = None
+        if arguments['--box']:
+            vertices = box_vertices(names[0], arguments['--box'])
+
+        (out, into) = build_labels(G, cost, hub_order(G, cost, int(arguments['--samples'])))
+        write_labels(arguments['<labelfile>'], out, into, graph_fingerprint(G, cost), vertices)
+
+        written = list(out) if vertices is None else vertices
+        hubs = sum(len(out[v]) + len(into[v]) for v in written)
+        print("labelled {} of {} vertices, {:.1f} hubs per label".format(len(written), G.num_vertices(), hubs / max(1, 2 * len(written))))
+
+    elif arguments['query']:
+        H = HubLabels(arguments['<labelfile>'])
+        try:
+            print(H.cost(int(arguments['<start>']), int(arguments['<dest>'])))
+        except KeyError as e:
+            print("vertex {} is not labelled".format(e))
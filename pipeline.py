@@ -0,0 +1,175 @@
+"""
+The pipelined line protocol, ROUTE/1, spoken by socket mode of server.py and
+by shard.py.
+
+A connection starts with the greeting line ROUTE/1, which the server sends
+back, and then each request is a line of integers, two for each point in
+100,000ths of degrees, optionally followed by flags such as id=<tag> or dist.
+A client may send any number of requests without waiting, and the replies
+come back in request order, one line each, as
+    <id> <version> OK <result>
+    <id> <version> NONE
+    <id> <version> BUSY
+    <id> <version> ERR <reason>
+where <id> is the tag of the request, or its number on the connection, and
+<version> is the version of the graph it was served from.
+
+Each front end supplies how a request is started and how its reply is made,
+and serve_pipeline does the rest: reading lines, keeping a window of requests
+in flight, and writing the replies through one buffer.
+"""
+
+from collections import deque
+
+from digraph import BudgetExceeded
+
+# The greeting that starts a connection using the pipelined line protocol
+PROTOCOL = b'ROUTE/1'
+
+
+def receive_greeting(connection, pending=b'', limit=8400):
+    """
+    Receives from connection until the greeting line is complete, given the
+    data received so far.  Returns the greeting, without its line end, and
+    the data received after it.  The greeting is empty if the client sends
+    nothing, and whatever arrived if it sends limit bytes without a line end.
+    """
+    while b'\n' not in pending and len(pending) < limit:
+        data = connection.recv(limit - len(pending))
+        if not data:
+            break
+        pending += data
+
+    (greeting, newline, pending) = pending.partition(b'\n')
+    return (greeting.rstrip(), pending)
+
+
+def parse_request(line, flags_known):
+    """
+    Parses a request line into the list of two or more points and a dict of
+    its flags, which must be among flags_known.  Raises ValueError if the
+    line is not a request.
+
+    >>> parse_request(b'1 2 3 4 id=a dist', ('id', 'dist'))
+    ([(1, 2), (3, 4)], {'id': 'a', 'dist': ''})
+    >>> parse_request(b'1 2 3', ('id',))
+    Traceback (most recent call last):
+    ...
+    ValueError: Expected two or more points, got 3 values
+    """
+    values = []
+    flags = {}
+
+    for field in line.decode('ascii').split():
+        if field[0].isalpha():
+            (key, equals, value) = field.partition('=')
+            if key not in flags_known:
+                raise ValueError("Unknown flag {}".format(key))
+            flags[key] = value
+        else:
+            values.append(int(field))
+
+    if len(values) < 4 or len(values) % 2:
+        raise ValueError("Expected two or more points, got {} values".format(len(values)))
+
+    return (list(zip(values[0::2], values[1::2])), flags)
+
+
+def reply_line(tag, version, future, reply, format, logger=None):
+    """
+    Returns the encoded reply line of a request.  If future is None the
+    request was answered straight away with reply.  Otherwise this waits for
+    its result, and replies NONE if it is None or empty, OK and format(result)
+    if not, or ERR if the request raised, logging anything but a spent budget
+    to logger if one is given.
+
+    >>> reply_line('a', 1, None, 'BUSY', str)
+    b'a 1 BUSY\\n'
+    """
+    if future is not None:
+        try:
+            result = future.result()
+        except BudgetExceeded as e:
+            reply = 'ERR {}'.format(e)
+        except Exception as e:
+            # One failed request must not take the connection down
+            if logger is not None:
+                logger.exception("Pipelined request {} failed".format(tag))
+            reply = 'ERR {}'.format(e)
+        else:
+            if result is None or result == []:
+                reply = 'NONE'
+            else:
+                reply = 'OK {}'.format(format(result))
+
+    return '{} {} {}\n'.format(tag, version, reply).encode('ascii')
+
+
+def serve_pipeline(connection, pending, submit, reply, window_size, ordered=None):
+    """
+    Serves the pipelined protocol on a connection whose greeting has been
+    received, until the client closes it.  Returns the number of requests
+    served.
+
+    Arguments:
+        connection  the socket of the connection
+        pending     the data received after the greeting
+        submit      called as submit(line, count) with each request line and
+                    its number on the connection, starting the request and
+                    returning an entry for it
+        reply       called as reply(*entry) in request order, waiting for the
+                    request and returning its encoded reply line
+        window_size the most requests of the connection in flight at once
+        ordered     if given, called as ordered(line), True for a line that
+                    must not start until every request before it has been
+                    answered, such as one changing what later requests see
+    """
+    writer = connection.makefile('wb', buffering=65536)
+    count = 0
+
+    # Requests of this connection that are being computed, oldest first.
+    # Keeping no more in flight than there are workers leaves room in the
+    # queue for other connections
+    window = deque()
+
+    try:
+        writer.write(PROTOCOL + b'\n')
+
+        while True:
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+
+            for line in lines:
+                if line.strip():
+                    if ordered is not None and ordered(line):
+                        while window:
+                            writer.write(reply(*window.popleft()))
+                    elif len(window) >= window_size:
+                        writer.write(reply(*window.popleft()))
+                    window.append(submit(line, count))
+                    count += 1
+
+            while window:
+                writer.write(reply(*window.popleft()))
+
+            # Replies to a burst of pipelined requests go out together, once
+            # every complete request received so far is answered
+            writer.flush()
+
+            data = connection.recv(65536)
+            if not data:
+                break
+            pending += data
+
+    finally:
+        try:
+            writer.close()
+        except OSError:
+            pass
+
+    return count
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
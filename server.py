@@ -2,7 +2,7 @@
 Usage:  server.py stdin [options]
         server.py shell [options]
         server.py sock [options]
-        server.py serial <port> [options]
+        server.py serial <port>... [options]
         server.py [options]
 
 Starts the python mapping server.
@@ -13,7 +13,18 @@ NOTE: For Assignment 3 Part 1, please execute
 All requests will be made by simply providing and latitude and longitude (in 100,000ths of degrees) of
 the start and end points in ASCII, separated by spaces and terminated by a newline.
 
+Each point is snapped onto the nearest road segment, and a route starting or ending part way along a
+road begins or ends with the snapped point itself.  Use --snap vertex to snap to the nearest vertex.
+
+A request may list more than two points, for a route through every one of them in turn.  With the
+option --reorder the stops between the first and the last are visited in whatever order is shortest.
+
 Modes:
+    shell: Starts the server and opens a python shell with it as self, for debugging.  For example
+        self._draw_lcp((5365488, -11333914), (5364727, -11335890), 'route.dot') writes the part of
+        the graph around a route to a dot file, with the route and the vertices its search settled
+        highlighted, to render with neato -n -Tpng route.dot
+
     stdin: The server will serve requests over stdin (Use for Assignment 3 Part 1)
         example
         contents of batch.txt: 5365488 -11333914 5364727 -11335890
@@ -29,27 +40,156 @@ Modes:
         5364756 -11335849
         5364727 -11335890
 
+        With --processes, requests are routed in parallel by that many worker processes forked with
+        the graph loaded.  Input is read in chunks of lines, each routed by one worker, and the output
+        is written in input order through one large buffer, exactly as it would be without them.
+        Invalid lines are logged when the output reaches them.
+
+    serial: The server will serve requests over each of the serial ports given at 9600 baud, as lines
+        of the same integers as stdin mode for two points, replying with the same lines stdin mode
+        prints.  Every port has one thread reading and routing its requests and another writing the
+        replies, so the next route is computed while the last one is still being sent, and each reply
+        is sent in one write.
+        example
+        >> server.py serial /dev/ttyACM0 /dev/ttyACM1
+
+    sock: The server will serve requests over a socket on localhost:8089.  Each connection sends a
+        python literal [[lat, long], [lat, long], ...] in degrees, and gets back a json list of the
+        [lat, long] points on the route.  A third element, as in [[lat, long], [lat, long], 3], asks for up to that
+        many alternative routes, and gets back a json list of routes, best first.  If the request fails
+        it gets back a json object {"error": <reason>}.
+
+        Requests are computed by a fixed pool of --workers threads.  When --queue requests are already
+        waiting for a worker, new requests are answered busy straight away, and when --max-connections
+        connections are open, new connections get the line BUSY and are closed.  A request whose searches
+        run past --deadline or --max-expansions is aborted with an error.
+
+        A connection that starts with the line ROUTE/1 instead speaks the pipelined line protocol, and
+        may send any number of requests without waiting for replies.  The server answers with the
+        line ROUTE/1, then each request is a line of the same integers as stdin mode, optionally
+        followed by flags:
+            id=<tag>    tag the reply with <tag> instead of the number of the request on the connection
+            alt=<k>     reply with up to k alternative routes
+            reorder     reorder the intermediate stops of a multi-stop request
+            dist        reply with the cost of the route in decimetres instead of its points
+        Replies come back in request order, one line each, as one of
+            <id> <version> OK <json list of [lat, long] points, or of routes for alt, or the cost for dist>
+            <id> <version> NONE
+            <id> <version> BUSY
+            <id> <version> ERR <reason>
+        where <version> is the version of the graph the request was served from.
+        example
+        >> printf 'ROUTE/1\\n5365488 -11333914 5364727 -11335890 id=a\\n1 2\\n' | nc localhost 8089
+        ROUTE/1
+        a 1 OK [[53.65488, -113.33914], [53.65238, -113.34423], ...]
+        1 1 ERR invalid request
+
+        A connection using the pipelined protocol may also change the cost of roads, with a line of
+            EDGE <start> <stop> <factor>    for the edge from one vertex id to another
+            STREET <factor> <name>          for every edge of the named street
+        where <factor> multiplies the length of each edge to give its cost, 1 restores it, and closed
+        closes it.  The reply is <id> <version> OK <number of edges changed>, and the change applies to
+        every request sent after it, but to none sent before it on the same connection.  Routes kept
+        for repeated requests (see --route-cache) are only dropped if they use an edge that got dearer,
+        or all of them if some edge got cheaper.  Changes are kept across reloads.
+
+        With --labels, dist requests between roads the hub labels cover are answered from the labels
+        without a search.  The labels are built offline with hublabel.py, and are only used if they were
+        built from the same graph, and while no edge has been changed from its cost in the graph.
+
+        Sending the server SIGHUP reloads the graph file without a restart.  The new graph and
+        everything derived from it are built in the background while requests are still served from
+        the old graph, then swapped in at once.  Requests already in progress finish on the old graph,
+        and the version reported in replies goes up by one.  Error objects sent to clients that are not
+        pipelined also carry the version, as {"error": <reason>, "version": <version>}.
+
 
 Arguments:
 
 Options:
   --graph <GRAPHFILE>  The file to load graph info [default: edmonton-roads-2.0.1.txt]
   --logfile <LOGFILE>  The location of the logfile [default: MappingServer.log]
+  --largest-scc        Only snap requests to roads in the largest strongly connected component
+  --snap <MODE>        Snap requests to the nearest "edge" or the nearest "vertex" [default: edge]
+  --reorder            Reorder the intermediate stops of multi-stop requests to shorten the route
+  --labels <FILE>      Answer distance requests from hub labels built by hublabel.py
+  --route-cache <N>    How many routes to keep for repeated requests, 0 for none [default: 1024]
+  --processes <N>      The number of worker processes routing stdin requests, 0 for none [default: 0]
+  --port <PORT>        The localhost port to serve socket mode on [default: 8089]
+  --deadline <MS>      Abort the searches of a request after this many milliseconds, 0 for none, by default
+                       5000 in sock mode and none otherwise
+  --max-expansions <N>  Abort the searches of a request after settling this many vertices, 0 for none [default: 0]
+  --workers <N>        The number of threads computing socket requests [default: 4]
+  --queue <N>          How many socket requests may wait for a worker before more are turned away [default: 64]
+  --max-connections <N>  How many socket connections may be open before more are turned away [default: 256]
   -h --help
   -v                 verbose mode
 
 """
 
+import copy
+import io
+import itertools
+import multiprocessing
+import queue
+from collections import OrderedDict
 import signal
 import sys
-import math
+import threading
 import docopt
 import logging
 import logging.handlers
 
-from digraph import least_cost_path
+from digraph import least_cost_path, least_cost_route, least_cost_routes, alternative_paths, strongly_connected_components, component_reach, SearchWorkspace, SearchBudget, BudgetExceeded
 from readgraph import readgraph
-from async import run_async
+from geometry import project_graph, distance, SegmentIndex
+from tour import order_stops
+from hublabel import HubLabels, graph_fingerprint
+from async import run_async, SingleFlight, BoundedExecutor
+from display import write_dot, box_subgraph, route_box, search_attributes
+from pipeline import PROTOCOL, receive_greeting, parse_request, reply_line, serve_pipeline
+
+# A request snapped to a road within this many decimetres of a vertex is
+# routed from the vertex itself
+SNAP_TOLERANCE = 20
+
+# In stdin mode with worker processes, the number of lines each worker routes
+# at a time, how many chunks per worker may be waiting to be written, and the
+# size of the output buffer
+BATCH_LINES = 64
+BATCH_AHEAD = 2
+BATCH_BUFFER = 1 << 20
+
+# In serial mode, how many replies may wait to be sent on a port before its
+# requests stop being read, and how many seconds a read waits before checking
+# whether the server is stopping
+SERIAL_QUEUE = 4
+SERIAL_POLL = 0.5
+
+# The server a stdin worker process routes with, inherited when it is forked
+_batch_server = None
+
+
+def _batch_worker(log_queue):
+    """
+    Starts a stdin worker process, which leaves SIGINT to the parent and
+    sends its log records to the parent through log_queue, rather than
+    writing and rotating the parent's log file alongside it
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    logger = _batch_server.logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def _batch_chunk(lines):
+    """
+    Routes a chunk of stdin lines in a worker process, returning the reply
+    to each
+    """
+    return [_batch_server._int_request(line) for line in lines]
 
 
 class MappingServer:
@@ -89,13 +229,41 @@ class MappingServer:
             self.logger.addHandler(vb)
             self.logger.info("Verbose mode activated")
 
-        # Read in graphfile into a graph object (self.G) and vertex names/data into (self.names)
-        self.logger.info("Reading graphfile...")
-        (self.G, self.names) = readgraph(arguments['--graph'])
-        self.logger.info("Reading of graphfile finished. Graph available.")
+        self.snap_mode = arguments.get('--snap') or 'edge'
+        self.reorder = arguments.get('--reorder', False)
+        self.port = int(arguments.get('--port') or 8089)
+
+        # Limits on the work done for each request, and on how many requests
+        # socket mode takes on at once
+        # A deadline only applies to socket clients by default, so that the
+        # output of stdin and serial mode never depends on the load
+        deadline = arguments.get('--deadline')
+        if deadline is None:
+            deadline = 5000 if arguments.get('sock') else 0
+        self.deadline = int(deadline) / 1000
+        self.max_expansions = int(arguments.get('--max-expansions') or 0)
+        self.workers = int(arguments.get('--workers') or 4)
+        self.queue_size = int(arguments.get('--queue') or 64)
+        self.max_connections = int(arguments.get('--max-connections') or 256)
+        self.processes = int(arguments.get('--processes') or 0)
+
+        self.graph_file = arguments['--graph']
+        self.largest_scc = arguments.get('--largest-scc', False)
+        self.labels_file = arguments.get('--labels')
+        self.cache_size = int(arguments.get('--route-cache') or 0)
+        self.update_lock = threading.Lock()
+        self._load_graph()
+
+        # The server holding the graph new requests are served from, which
+        # is replaced by a copy holding a newer graph on every reload
+        self.version = 1
+        self.live = self
+        self.reload_lock = threading.Lock()
 
         # Parse configuration options
-        if arguments['stdin']:
+        if arguments['stdin'] and self.processes:
+            self._batch_mode()
+        elif arguments['stdin']:
             self._int_mode()
         elif arguments['shell']:
             import code
@@ -107,142 +275,353 @@ class MappingServer:
         else:
             pass
 
-    def _serial_mode(self, port):
+    def _load_graph(self):
+        """
+        Reads the graph file and builds everything derived from the graph:
+        the component reachability, the projection, the snapping indexes,
+        the hub labels, the search workspaces, the in flight requests and the
+        route cache
+        """
+        # Read in graphfile into a graph object (self.G) and vertex names/data into (self.names)
+        self.logger.info("Reading graphfile...")
+        (self.G, self.names) = readgraph(self.graph_file)
+        self.logger.info("Reading of graphfile finished. Graph available.")
+
+        # Precompute the strongly connected components, so that requests with
+        # no route can be rejected without exhausting a search
+        self.logger.info("Computing strongly connected components...")
+        self.component = strongly_connected_components(self.G)
+        self.reach = component_reach(self.G, self.component)
+        self.logger.info("Graph has {} strongly connected components.".format(len(self.reach)))
+
+        # Project every vertex onto a local plane in integer decimetres and
+        # store the length of every edge, so that searches add and compare
+        # ints that mean something on the ground
+        (self.projection, self.xy, self.weights) = project_graph(self.G, self.names[0])
+
+        # Index the vertices and road segments requests may snap to,
+        # optionally restricted to the largest strongly connected component so
+        # that clients do not land on isolated dead-end fragments
+        snap_ids = self.names[2].values()
+        snap_edges = self.weights.keys()
+        if self.largest_scc and self.reach:
+            sizes = [0] * len(self.reach)
+            for v in self.component:
+                sizes[self.component[v]] += 1
+            largest = sizes.index(max(sizes))
+
+            snap_ids = [v for v in snap_ids if self.component[v] == largest]
+            snap_edges = [e for e in snap_edges if self.component[e[0]] == self.component[e[1]] == largest]
+            self.logger.info("Snapping restricted to {} vertices of the largest component.".format(len(snap_ids)))
+
+        self.snap_vertices = SegmentIndex((v, self.xy[v], self.xy[v]) for v in snap_ids)
+
+        # A two way road is indexed once, as whichever of its edges comes
+        # first.  snap_roads maps each road that may be snapped to, as its
+        # (lower, higher) vertex ids, to the edge it is indexed as
+        self.snap_edges = SegmentIndex()
+        self.snap_roads = {}
+        for (u, v) in snap_edges:
+            if (v, u) not in self.weights or (u, v) < (v, u):
+                self.snap_edges.add((u, v), self.xy[u], self.xy[v])
+                self.snap_roads[(min(u, v), max(u, v))] = (u, v)
+
+        # The edges of each street, for closing or slowing a whole street
+        self.streets = {}
+        for (e, name) in self.names[1].items():
+            self.streets.setdefault(name, []).append(e)
+
+        # Hub labels answer distance requests without a search, but only
+        # while they match the graph they were built from.  hub_labels keeps
+        # them while edge updates leave labels unset
+        self.labels = self.hub_labels = None
+        if self.labels_file:
+            labels = HubLabels(self.labels_file)
+            if labels.fingerprint == graph_fingerprint(self.G, self.weights.get):
+                self.labels = self.hub_labels = labels
+                self.logger.info("Loaded hub labels of {} vertices.".format(len(labels)))
+            else:
+                self.logger.error("Hub labels in {} were built from a different graph, not using them".format(self.labels_file))
+                labels.close()
+
+        # Search workspaces are reused between requests, one per concurrently
+        # running search, and all share the same dense vertex numbering
+        self.vertex_index = dict((v, i) for (i, v) in enumerate(self.G.vertices()))
+        self.workspaces = []
+
+        # Concurrent requests for the same snapped route share one search
+        self.flight = SingleFlight()
+
+        # Routes between snapped points, least recently used first, and the
+        # keys of the routes that use each edge, so that an edge getting
+        # dearer only drops the routes it is on.  epoch counts edge updates,
+        # so that a route searched before an update is not cached after it.
+        # cache_hits counts the requests answered from the cache, which never
+        # reach the in flight requests
+        self.cache = OrderedDict()
+        self.cache_routes = {}
+        self.cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.epoch = 0
+
+        # The factor of every edge changed from its length, or None if it
+        # is closed, to apply again after a reload
+        self.overrides = {}
+
+    @run_async
+    def _reload(self):
+        """
+        Loads the graph file again into a copy of the live server, and swaps
+        it in once it is ready.  Requests holding the old server finish on
+        the old graph, and only one reload runs at a time.
+        """
+        if not self.reload_lock.acquire(False):
+            self.logger.error("Reload already in progress, ignoring SIGHUP")
+            return
+
+        try:
+            old = self.live
+            self.logger.info("Reloading graph version {} from {}...".format(old.version + 1, self.graph_file))
+
+            # The copy shares the configuration, the workers and the socket,
+            # and replaces everything derived from the graph
+            server = copy.copy(old)
+            server._load_graph()
+            server.version = old.version + 1
+            server.live = server
+
+            # Edge changes made while the graph was loading must not be lost
+            with self.update_lock:
+                server._change_edges(dict((e, f) for (e, f) in self.live.overrides.items() if e in server.weights))
+                self.live = server
+
+            # The old server drops its labels, so that they are closed once
+            # the requests still running on it let go of them too
+            old.labels = old.hub_labels = None
+            self.logger.info("Graph version {} live, version {} served {} routes".format(server.version, old.version, old.flight.calls + old.cache_hits))
+        except Exception as e:
+            self.logger.error("Reload failed, still serving version {}: {}".format(self.live.version, e))
+        finally:
+            self.reload_lock.release()
+
+    def _reload_sig_handler(self, signal, frame):
+        """
+        Handles a SIGHUP signal, reloading the graph in the background, for use with socket mode.
+        """
+        self._reload()
+
+    def _serial_mode(self, ports):
+        """
+        Serial mode. Serves every port concurrently until interrupted
+        """
         import serial
 
-        self.logger.info("Opening serial port: {}".format(port))
-        self.serial_out = self.serial_in = serial.Serial(port, 9600)
+        # Every port is opened before any is served, so that one failing to
+        # open leaves no reader running
+        devices = []
+        try:
+            for port in ports:
+                self.logger.info("Opening serial port: {}".format(port))
+                devices.append(serial.Serial(port, 9600, timeout=SERIAL_POLL))
+        except Exception:
+            for device in devices:
+                device.close()
+            raise
+
+        stop = threading.Event()
+        readers = [self._serve_serial(device, port, stop) for (device, port) in zip(devices, ports)]
 
         try:
-            idx = 0
-            while True:
-                msg = self._serial_receive()
+            for reader in readers:
+                reader.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+
+    @run_async
+    def _serve_serial(self, device, port, stop):
+        """
+        Reads and routes the requests of one serial port, handing each reply
+        to a writer thread so that the next route is computed while the last
+        one is sent
+        """
+        replies = queue.Queue(SERIAL_QUEUE)
+        writer = self._serial_writer(device, port, replies)
 
-                self.logger.debug("GOT:" + msg + ":")
+        line = b''
+        try:
+            while not stop.is_set():
+                # A read that times out returns what it has of the line so far
+                line += device.readline()
+                if not line.endswith(b'\n'):
+                    continue
+                (msg, line) = (line, b'')
 
                 try:
+                    msg = msg.decode('ascii').rstrip('\n\r')
+                    self.logger.debug("GOT:" + msg + ":")
                     point_1, point_2 = self._prepare_string(msg)
                 except ValueError:
-                    # self.logger.error("Invalid input> {}".format(msg.rstrip()))
                     continue
 
                 # Compute the least_cost_path from the two points
-                _lcp = self._lcp(point_1, point_2)
-
-                self.logger.info("Sending LCP over serial...")
+                try:
+                    _lcp = self._lcp(point_1, point_2)
+                except BudgetExceeded as e:
+                    self.logger.error("Request aborted> {}: {}".format(msg, e))
+                    _lcp = None
 
                 if _lcp:
-                    self._serial_send(len(_lcp))
-
-                    for vertex_id in _lcp:
-
-                        point = self.names[0][vertex_id]
-
-                        point = self._coord_trans(point)
-
-                        self._serial_send('{0[0]} {0[1]}'.format(point))
+                    replies.put(self._format_lcp(_lcp).encode('ascii'))
 
-                self.logger.info("Serial send finished!")
-
-                # Print the result using formatter function
-                # self._print_lcp(_lcp)
-                idx += 1
-
-        except KeyboardInterrupt:
-            pass
         except OSError as e:
-            if e.errno == 6:
-                self.logger.error("Serial Device disconnected before serial interface closed.")
-            else:
-                raise e
-
-    def _serial_send(self, message):
-        """
-        Sends a message back to the client device.
-        """
-        full_message = ''.join((str(message), "\n"))
-
-        # self.logger.debug("server:" + str(message) + ":")
+            self.logger.error("Serial device {} disconnected: {}".format(port, e))
 
-        reencoded = bytes(full_message, encoding='ascii')
-        self.serial_out.write(reencoded)
+        finally:
+            replies.put(None)
+            writer.join()
+            device.close()
 
-    def _serial_receive(self, timeout=None):
+    @run_async
+    def _serial_writer(self, device, port, replies):
         """
-        Listen for a message. Attempt to timeout after a certain number of
-        milliseconds.
+        Sends the replies queued for a serial port, until it gets None
         """
-        raw_message = self.serial_in.readline()
-
-        # self.logger.debug("client:" + str(raw_message) + ":")
+        broken = False
+        while True:
+            reply = replies.get()
+            if reply is None:
+                return
 
-        message = raw_message.decode('ascii')
+            # Keep taking replies after a failed write, so that the reader
+            # never blocks on a full queue
+            if broken:
+                continue
 
-        return message.rstrip("\n\r")
+            self.logger.info("Sending LCP over serial {}...".format(port))
+            try:
+                device.write(reply)
+            except OSError as e:
+                self.logger.error("Serial device {} disconnected: {}".format(port, e))
+                broken = True
+                continue
+            self.logger.info("Serial send finished!")
 
     def _print_lcp(self, path):
         """
         Prints the _lcp in the desired format, displays nothing if there is no path.
         """
-        if path:
-            print(len(path))
-
-            for vertex_id in path:
+        sys.stdout.write(self._format_lcp(path))
 
-                point = self.names[0][vertex_id]
+    def _format_lcp(self, path):
+        """
+        Returns the text _print_lcp prints for a path, which is empty if there
+        is no path.
+        """
+        if not path:
+            return ''
 
-                point = self._coord_trans(point)
+        lines = [str(len(path))]
+        for point in path:
+            lines.append('{0[0]} {0[1]}'.format(self._coord_trans(point)))
 
-                print('{0[0]} {0[1]}'.format(point))
+        return '\n'.join(lines) + '\n'
 
     def _json_lcp(self, path):
         """
-        Returns a json string of the path, for use with the socket mode.
+        Returns a json string of the path, or of a list of alternative paths,
+        for use with the socket mode.
         """
         import json
 
-        if path:
-
-            points = []
-
-            for vertex_id in path:
-
-                point = self.names[0][vertex_id]
+        if path is not None:
 
-                points.append(point)
-
-            return json.dumps(points)
+            return json.dumps(path)
 
     @run_async
     def _socket_request(self, connection, address):
         """
         Handles a socket request, parsing the input coords and outputting a json formmatted response
         """
+        try:
+            self._socket_connection(connection, address)
+        finally:
+            connection.close()
+            self.connections.release()
+
+    def _socket_connection(self, connection, address):
+        """
+        Serves a socket connection, with either the pipelined protocol or a single request
+        """
         import ast
+        import json
 
         self.logger.info(str(address[0]) + " Connection made, recieving data")
 
-        buf = connection.recv(8400)
+        buf = self._receive_start(connection)
+
+        if buf.startswith(b'ROUTE/'):
+            (version, pending) = receive_greeting(connection, buf)
+            if version == PROTOCOL:
+                self.logger.info(str(address[0]) + " Using the pipelined protocol")
+                self._pipeline(connection, address, pending)
+            else:
+                connection.sendall(b'ERR unsupported protocol ' + version + b'\n')
+                connection.close()
+            return
 
         if len(buf) > 0:
-            coords = ast.literal_eval(buf.decode('utf-8'))
+            # The request may be a list or a tuple
+            try:
+                coords = list(ast.literal_eval(buf.decode('utf-8')))
+            except (ValueError, SyntaxError, TypeError):
+                self.logger.error(str(address[0]) + " Invalid request, closing connection")
+                return
 
-            base_coord = (self._coord_trans(coords[0]), self._coord_trans(coords[1]))
+            # An optional int after two points asks for that many alternative routes
+            alternatives = 0
+            if len(coords) == 3 and isinstance(coords[2], int):
+                alternatives = coords.pop()
 
+            # Every point must be a (lat, long) pair of numbers before any is
+            # transformed, and infinite or undefined numbers have no int
             try:
-                if len(base_coord) != 2 or len(base_coord[0]) != 2 or len(base_coord[1]) != 2:
-                    raise IndexError()
-            except IndexError:
-                connection.close()
+                if len(coords) < 2 or not all(isinstance(coord, (list, tuple)) and len(coord) == 2 and
+                                              all(isinstance(x, (int, float)) for x in coord) for coord in coords):
+                    raise ValueError("Expected two or more points")
+                base_coord = [self._coord_trans(coord) for coord in coords]
+            except (ValueError, OverflowError):
+                self.logger.error(str(address[0]) + " Invalid request, closing connection")
                 return
 
             self.logger.info(str(address[0]) + " Recieved data, sending reply.")
-            self.logger.info(str(address[0]) + " Request to serve route from ({0[0]}, {0[1]}) to ({1[0]}, {1[1]})".format(base_coord[0], base_coord[1]))
+            self.logger.info(str(address[0]) + " Request to serve route from ({0[0]}, {0[1]}) to ({1[0]}, {1[1]})".format(base_coord[0], base_coord[-1]))
 
-            _lcp = self._lcp(base_coord[0], base_coord[1])
+            # The whole request is served from the graph live when it arrived
+            server = self.live
 
-            if _lcp:
-                self.logger.info(str(address[0]) + " Route will require {} steps".format(len(_lcp)))
+            try:
+                _lcp = self.executor.submit(server._serve, base_coord, alternatives, self.reorder).result()
+            except queue.Full:
+                self.logger.error(str(address[0]) + " Too many requests waiting, replying busy")
+                _lcp = {'error': 'busy', 'version': server.version}
+            except BudgetExceeded as e:
+                self.logger.error(str(address[0]) + " Request aborted: {}".format(e))
+                _lcp = {'error': str(e), 'version': server.version}
+            except Exception as e:
+                self.logger.exception(str(address[0]) + " Request failed")
+                _lcp = {'error': str(e), 'version': server.version}
+
+            if isinstance(_lcp, dict):
+                connection.send(json.dumps(_lcp).encode('utf-8'))
+            elif _lcp:
+                if alternatives:
+                    self.logger.info(str(address[0]) + " Found {} alternative routes".format(len(_lcp)))
+                else:
+                    self.logger.info(str(address[0]) + " Route will require {} steps on graph version {}".format(len(_lcp), server.version))
 
                 json_to_send = self._json_lcp(_lcp)
 
@@ -255,13 +634,145 @@ class MappingServer:
             self.logger.info(str(address[0]) + " Closed connection")
             return
 
+    def _receive_start(self, connection, limit=8400):
+        """
+        Receives the start of a connection, until it is known to be the
+        greeting of the pipelined protocol or holds a whole single request,
+        the client stops sending, or limit bytes have arrived.  Either may
+        come in several segments.
+        """
+        import ast
+
+        buf = b''
+        while len(buf) < limit:
+            data = connection.recv(limit - len(buf))
+            if not data:
+                break
+            buf += data
+
+            # The greeting, or too little of the start to tell
+            if buf.startswith(b'ROUTE/'[:len(buf)]):
+                if len(buf) >= len(b'ROUTE/'):
+                    break
+                continue
+
+            try:
+                ast.literal_eval(buf.decode('utf-8'))
+                break
+            except (ValueError, SyntaxError, TypeError):
+                continue
+
+        return buf
+
+    def _pipeline(self, connection, address, pending):
+        """
+        Serves the pipelined line protocol on a connection until the client
+        closes it.  pending holds any data received after the greeting.
+        """
+        try:
+            # An EDGE or STREET line waits for the requests before it, so
+            # that they are computed with the costs they were sent under
+            count = serve_pipeline(connection, pending, self._pipeline_submit, self._pipeline_reply, self.workers, lambda line: line[:1].isalpha())
+            self.logger.info(str(address[0]) + " Served {} pipelined requests, closed connection".format(count))
+        except OSError as e:
+            self.logger.info(str(address[0]) + " Connection lost: {}".format(e))
+        finally:
+            connection.close()
+
+    def _pipeline_submit(self, line, count):
+        """
+        Parses one request of the pipelined protocol and hands it to the
+        workers.  Returns the tag of the request, the graph version it is
+        served from, and either the future of its result or the reply if it
+        was answered straight away
+        """
+        if line[:1].isalpha():
+            (version, reply) = self._pipeline_update(line)
+            return (count, version, None, reply)
+
+        server = self.live
+
+        try:
+            (stops, flags) = parse_request(line, ('id', 'alt', 'reorder', 'dist'))
+            alternatives = int(flags.get('alt', 0))
+        except (ValueError, UnicodeDecodeError):
+            return (count, server.version, None, 'ERR invalid request')
+
+        tag = flags.get('id') or count
+
+        try:
+            future = self.executor.submit(server._serve, stops, alternatives, self.reorder or 'reorder' in flags, 'dist' in flags)
+        except queue.Full:
+            return (tag, server.version, None, 'BUSY')
+
+        return (tag, server.version, future, None)
+
+    def _pipeline_update(self, line):
+        """
+        Applies an EDGE or STREET line of the pipelined protocol to the live
+        server, returning the graph version it applied to and the reply
+        """
+        edges = street = None
+        try:
+            fields = line.decode('ascii').split()
+            if fields[0] == 'EDGE' and len(fields) == 4:
+                edges = [(int(fields[1]), int(fields[2]))]
+                factor = fields[3]
+            elif fields[0] == 'STREET' and len(fields) >= 3:
+                street = ' '.join(fields[2:])
+                factor = fields[1]
+            else:
+                raise ValueError("Unknown command {}".format(fields[0]))
+
+            if factor == 'closed':
+                factor = None
+            else:
+                factor = float(factor)
+                if not factor > 0:
+                    raise ValueError("Factor {} is not positive".format(factor))
+        except (ValueError, UnicodeDecodeError):
+            return (self.live.version, 'ERR invalid update')
+
+        (version, changed) = self._update_edges(factor, edges, street)
+        return (version, 'OK {}'.format(changed))
+
+    def _pipeline_reply(self, tag, version, future, reply):
+        """
+        Waits for the result of a pipelined request, returning the encoded
+        reply line
+        """
+        return reply_line(tag, version, future, reply, self._json_lcp, self.logger)
+
+    def _serve(self, stops, alternatives=0, reorder=False, dist=False):
+        """
+        Computes the answer to a socket request: a route through the stops,
+        a list of alternative routes between two stops, or the cost of the
+        route through the stops if dist is set
+        """
+        if dist:
+            costs = [self._distance(a, b) for (a, b) in zip(stops, stops[1:])]
+            if None in costs:
+                return None
+            return sum(costs)
+
+        if alternatives and len(stops) == 2:
+            return self._alternatives(stops[0], stops[1], alternatives)
+        elif len(stops) > 2:
+            return self._multi_lcp(stops, reorder)
+
+        return self._lcp(stops[0], stops[1])
+
     def _sock_sig_handler(self, signal, frame):
         """
         Handles a SIGINT signal, closing the socket connection, for use with socket mode.
         """
         self.logger.error("SIGINT caught during socket mode, closing socket..")
+        live = self.live
+        self.logger.info("Served {} routes on graph version {}, {} of them from the route cache and {} shared with an identical request in flight".format(live.flight.calls + live.cache_hits, live.version, live.cache_hits, live.flight.shared))
+        import socket
+
         try:
-            self.serversocket.shutdown(self.serversocket.SHUT_RDWR)
+            self.serversocket.shutdown(socket.SHUT_RDWR)
         except OSError:
             pass
         self.serversocket.close()
@@ -275,11 +786,15 @@ class MappingServer:
         import socket
 
         old_sig = signal.signal(signal.SIGINT, self._sock_sig_handler)
+        old_hup = signal.signal(signal.SIGHUP, self._reload_sig_handler)
+
+        self.executor = BoundedExecutor(self.workers, self.queue_size)
+        self.connections = threading.BoundedSemaphore(self.max_connections)
 
         try:
             self.logger.info("Binding to socket.")
             self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.serversocket.bind(('localhost', 8089))
+            self.serversocket.bind(('localhost', self.port))
             self.serversocket.listen(10)
 
             while True:
@@ -288,6 +803,16 @@ class MappingServer:
                 while True:
                     connection, address = self.serversocket.accept()
 
+                    # Turn the connection away rather than start yet another thread
+                    if not self.connections.acquire(False):
+                        self.logger.error(str(address[0]) + " Too many connections, replying busy")
+                        try:
+                            connection.sendall(b'BUSY\n')
+                        except OSError:
+                            pass
+                        connection.close()
+                        continue
+
                     self._socket_request(connection, address)
 
         except KeyboardInterrupt:
@@ -298,6 +823,7 @@ class MappingServer:
             self.serversocket.close()
 
         signal.signal(signal.SIGINT, old_sig)
+        signal.signal(signal.SIGHUP, old_hup)
 
     def _prepare_string(self, string):
         """
@@ -311,6 +837,16 @@ class MappingServer:
 
         return (point_1, point_2)
 
+    def _prepare_stops(self, string):
+        """
+        Parses a input from stdin to a list of two or more points
+        """
+        values = [int(x) for x in string.rstrip().split(" ")]
+        if len(values) < 4 or len(values) % 2:
+            raise ValueError("Expected two or more points, got {} values".format(len(values)))
+
+        return list(zip(values[0::2], values[1::2]))
+
     def _int_mode(self):
         """
         Standard input mode. Parses and returns directions from desired entry coordinates within the mapfiles boundries
@@ -321,61 +857,660 @@ class MappingServer:
 
         try:
             for line in self.request:
-                try:
-                    point_1, point_2 = self._prepare_string(line)
-                except ValueError:
-                    self.logger.error("Invalid input> {}".format(line.rstrip()))
-                    continue
-
-                # Compute the least_cost_path from the two points
-                _lcp = self._lcp(point_1, point_2)
+                (text, error) = self._int_request(line)
+                if error is not None:
+                    self.logger.error(error)
 
-                # Print the result using formatter function
-                self._print_lcp(_lcp)
+                sys.stdout.write(text)
 
         except KeyboardInterrupt:
             pass
 
+    def _int_request(self, line):
+        """
+        Computes the reply to one line of stdin.  Returns the text to print,
+        which is empty if there is no route, and the error to log if the line
+        could not be routed, or None
+        """
+        try:
+            stops = self._prepare_stops(line)
+        except ValueError:
+            return ('', "Invalid input> {}".format(line.rstrip()))
+
+        # Compute the least_cost_path from the two points, or through all of
+        # the stops
+        try:
+            if len(stops) == 2:
+                _lcp = self._lcp(stops[0], stops[1])
+            else:
+                _lcp = self._multi_lcp(stops, self.reorder)
+        except BudgetExceeded as e:
+            return ('', "Request aborted> {}: {}".format(line.rstrip(), e))
+
+        return (self._format_lcp(_lcp), None)
+
+    def _batch_mode(self):
+        """
+        Standard input mode with worker processes.  Chunks of lines are routed
+        in parallel, and the replies written in input order through one
+        buffer, with the errors of lines that were not routed logged in their
+        place
+        """
+        global _batch_server
+
+        self.logger.info("stdin startup mode selected, with {} worker processes".format(self.processes))
+
+        # The workers are forked with the graph already loaded, and this
+        # process writes their log records through its own handlers
+        _batch_server = self
+        context = multiprocessing.get_context('fork')
+        log_queue = context.Queue()
+        listener = logging.handlers.QueueListener(log_queue, *self.logger.handlers, respect_handler_level=True)
+        listener.start()
+        pool = context.Pool(self.processes, _batch_worker, (log_queue,))
+
+        sys.stdout.flush()
+        out = io.BufferedWriter(io.FileIO(sys.stdout.fileno(), 'w', closefd=False), BATCH_BUFFER)
+
+        # Chunks being routed, oldest first, so that replies are written in
+        # order and at most BATCH_AHEAD chunks per worker are held at once
+        pending = []
+
+        def write_oldest():
+            for (text, error) in pending.pop(0).get():
+                if error is not None:
+                    self.logger.error(error)
+                out.write(text.encode('ascii'))
+
+        try:
+            for lines in iter(lambda: list(itertools.islice(sys.stdin, BATCH_LINES)), []):
+                pending.append(pool.apply_async(_batch_chunk, (lines,)))
+                if len(pending) > self.processes * BATCH_AHEAD:
+                    write_oldest()
+
+            while pending:
+                write_oldest()
+            pool.close()
+
+        except KeyboardInterrupt:
+            pool.terminate()
+
+        out.flush()
+        pool.join()
+        listener.stop()
+
     def _coord_trans(self, coord):
         """
         Transforms decimal coordinates into 100,000ths of degrees
         """
         return (int(coord[0] * 100000), int(coord[1] * 100000))
 
+    def _project_request(self, coord):
+        """
+        Projects a request coordinate in 100,000ths of degrees onto the plane
+        """
+        return self.projection.project((coord[0] / 100000, coord[1] / 100000))
+
     def _lookup_id(self, coord):
         """
-        Looks up the closest id given a set of coordinates
+        Looks up the closest id given a set of coordinates in 100,000ths of degrees
+        """
+        return self.snap_vertices.nearest(self._project_request(coord))[1]
+
+    def _snap(self, coord):
+        """
+        Snaps a coordinate in 100,000ths of degrees onto the nearest road.
+        Returns (u, v, t) for the point a fraction t of the way along the edge
+        (u, v), or (v, v, 0) for the vertex v.
+        """
+        if self.snap_mode == 'vertex':
+            v = self._lookup_id(coord)
+            return (v, v, 0)
+
+        (d2, (u, v), t) = self.snap_edges.nearest(self._project_request(coord))
+
+        length = distance(self.xy[u], self.xy[v])
+        if t * length <= SNAP_TOLERANCE:
+            return (u, u, 0)
+        if (1 - t) * length <= SNAP_TOLERANCE:
+            return (v, v, 0)
+
+        return (u, v, t)
+
+    def _snap_coord(self, snap):
+        """
+        Returns the (lat, long) of a snapped point
+        """
+        (u, v, t) = snap
+        (p, q) = (self.names[0][u], self.names[0][v])
+
+        return (p[0] + t * (q[0] - p[0]), p[1] + t * (q[1] - p[1]))
+
+    def _sources(self, snap):
+        """
+        Returns the vertices a route leaving a snapped point can reach first,
+        mapped to the cost of getting there
+        """
+        (u, v, t) = snap
+        if u == v:
+            return {u: 0}
+
+        # Either way along the road may have been closed
+        sources = {}
+        w = self.weights.get((u, v))
+        if w is not None:
+            sources[v] = int(round((1 - t) * w))
+        w = self.weights.get((v, u))
+        if w is not None:
+            sources[u] = int(round(t * w))
+
+        return sources
+
+    def _targets(self, snap):
         """
-        coord_id = min(self.names[2].items(), key=lambda x: self._cost_function((coord, x[0]), True))[1]
-        return coord_id
+        Returns the vertices a route can reach a snapped point from, mapped to
+        the cost of the rest of the way
+        """
+        (u, v, t) = snap
+        if u == v:
+            return {u: 0}
+
+        targets = {}
+        w = self.weights.get((u, v))
+        if w is not None:
+            targets[u] = int(round(t * w))
+        w = self.weights.get((v, u))
+        if w is not None:
+            targets[v] = int(round((1 - t) * w))
+
+        return targets
+
+    def _direct_cost(self, start, dest):
+        """
+        Returns the cost of driving straight from one snapped point to another
+        on the same road, or None if that is not possible
+        """
+        (u, v, ts) = start
+        (a, b, td) = dest
+        if u == v or (u, v) != (a, b):
+            return None
+
+        if ts <= td:
+            w = self.weights.get((u, v))
+            if w is not None:
+                return int(round((td - ts) * w))
+        else:
+            w = self.weights.get((v, u))
+            if w is not None:
+                return int(round((ts - td) * w))
+
+        return None
 
     def _cost_function(self, points, coords_ovr=False):
         """
-        Computes the distance from a set of coordinates using a metric
+        Computes the distance in decimetres between two vertices, or between
+        two (lat, long) coordinates if coords_ovr is set.  The cost of an edge
+        is its length times any factor it was updated with, or None if it is
+        closed
         """
+        if not coords_ovr:
+            try:
+                return self.weights[points]
+            except KeyError:
+                pass
+
         try:
             if not coords_ovr:
-                p1 = self.names[0][points[0]]
-                p2 = self.names[0][points[1]]
+                p1 = self.xy[points[0]]
+                p2 = self.xy[points[1]]
             else:
-                p1 = points[0]
-                p2 = points[1]
+                p1 = self.projection.project(points[0])
+                p2 = self.projection.project(points[1])
         except KeyError:
             return None
 
-        return math.sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2)
+        return distance(p1, p2)
 
-    def _lcp(self, start_coord, dest_coord):
+    def _reachable(self, start, dest):
         """
-        Computes the least_cost_path from start_coord to dest_coord
+        Returns True if there is any route from vertex start to vertex dest,
+        using the precomputed component reachability
         """
+        return bool(self.reach[self.component[start]] >> self.component[dest] & 1)
 
-        start = self._lookup_id(start_coord)
-        dest = self._lookup_id(dest_coord)
+    def _budget(self):
+        """
+        Returns a new SearchBudget for the searches of one request
+        """
+        return SearchBudget(self.max_expansions or None, self.deadline or None)
+
+    def _acquire_workspace(self):
+        """
+        Takes a free search workspace from the pool, creating one if every
+        workspace is in use by another thread
+        """
+        try:
+            return self.workspaces.pop()
+        except IndexError:
+            self.logger.debug("Allocating a new search workspace")
+            return SearchWorkspace(self.G, self.vertex_index)
+
+    def _release_workspace(self, workspace):
+        """
+        Returns a search workspace to the pool for the next request
+        """
+        self.workspaces.append(workspace)
+
+    def _lcp(self, start_coord, dest_coord):
+        """
+        Computes the least_cost_path from start_coord to dest_coord, returning
+        the (lat, long) points along it or None if there is no route
+        """
+        start = self._snap(start_coord)
+        dest = self._snap(dest_coord)
 
         self.logger.info("Getting least_cost_path from ({}) to ({})".format(start_coord, dest_coord))
 
-        return least_cost_path(self.G, start, dest, self._cost_function)
+        return self._route(start, dest)
+
+    def _route(self, start, dest):
+        """
+        Computes the least cost route between two snapped points, returning
+        the (lat, long) points along it or None if there is no route.  A
+        route found before is taken from the cache, and a request for a route
+        that is already being computed waits for that result instead of
+        searching again.
+        """
+        key = (start, dest)
+        with self.cache_lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                return cached[0]
+            epoch = self.epoch
+
+        (points, edges) = self.flight.do((start, dest, epoch), self._search_route, start, dest)
+
+        if self.cache_size:
+            self._cache_route(key, epoch, points, edges)
+
+        return points
+
+    def _cache_route(self, key, epoch, points, edges):
+        """
+        Keeps a route for repeated requests, unless an edge was updated
+        since its search started
+        """
+        with self.cache_lock:
+            if epoch != self.epoch:
+                return
+
+            self.cache[key] = (points, edges)
+            for e in edges:
+                self.cache_routes.setdefault(e, set()).add(key)
+
+            while len(self.cache) > self.cache_size:
+                self._drop_route(next(iter(self.cache)))
+
+    def _drop_route(self, key):
+        """
+        Drops a route from the cache, if it is there.  The caller holds
+        cache_lock
+        """
+        cached = self.cache.pop(key, None)
+        if cached is None:
+            return
+
+        for e in cached[1]:
+            keys = self.cache_routes[e]
+            keys.discard(key)
+            if not keys:
+                del self.cache_routes[e]
+
+    def _update_edges(self, factor, edges=None, street=None):
+        """
+        Sets the cost of each of the edges, or of every edge of the named
+        street, to factor times its length, or closes it if factor is None,
+        for every request that starts after.  Returns the version of the live
+        graph and the number of its edges that changed
+        """
+        with self.update_lock:
+            # The live server is only looked up holding the lock, which a
+            # reload holds until its new server is live, so that no update
+            # is made to a server that has just been replaced
+            server = self.live
+            if street is not None:
+                edges = server.streets.get(street, [])
+            changed = server._change_edges(dict((e, factor) for e in edges if e in server.weights))
+            return (server.version, changed)
+
+    def _change_edges(self, factors):
+        """
+        Applies a dict mapping edges to their new factor (or None), and
+        repairs whatever depends on their costs.  The caller holds
+        update_lock.  Returns the number of edges that changed
+        """
+        dearer = []
+        cheaper = []
+        roads = set()
+
+        for (e, factor) in factors.items():
+            old = self.weights[e]
+            new = None
+            if factor is not None:
+                new = int(round(distance(self.xy[e[0]], self.xy[e[1]]) * factor))
+            if new == old:
+                continue
+
+            self.weights[e] = new
+            if factor == 1:
+                self.overrides.pop(e, None)
+            else:
+                self.overrides[e] = factor
+
+            if old is None or (new is not None and new < old):
+                cheaper.append(e)
+            else:
+                dearer.append(e)
+
+            # A road is snapped to while either of its edges is open
+            if old is None or new is None:
+                roads.add((min(e), max(e)))
+
+        for road in roads:
+            if road in self.snap_roads:
+                self._index_road(road)
+
+        changed = len(dearer) + len(cheaper)
+        if not changed:
+            return 0
+
+        # A route only gets worse if an edge on it got dearer, but any route
+        # may be beaten by one using an edge that got cheaper.  The component
+        # reachability was found with every edge open, so it still never
+        # rejects a request that has a route
+        with self.cache_lock:
+            self.epoch += 1
+            if cheaper:
+                self.cache.clear()
+                self.cache_routes.clear()
+            else:
+                for e in dearer:
+                    for key in list(self.cache_routes.get(e, ())):
+                        self._drop_route(key)
+
+        # The labels hold the costs of the graph as it was read, so they are
+        # set aside while any edge differs from them
+        labels = self.hub_labels if not self.overrides else None
+        if labels is not self.labels:
+            if labels is None:
+                self.logger.error("Hub labels no longer match the edge costs, answering distances by search")
+            else:
+                self.logger.info("Edge costs restored, answering distances from the hub labels")
+            self.labels = labels
+
+        self.logger.info("Updated {} edges, {} dearer and {} cheaper".format(changed, len(dearer), len(cheaper)))
+        return changed
+
+    def _index_road(self, road):
+        """
+        Indexes a road for snapping as the first of its edges that is open,
+        or not at all if both are closed
+        """
+        indexed = self.snap_roads[road]
+        if indexed is not None:
+            self.snap_edges.remove(indexed, self.xy[indexed[0]], self.xy[indexed[1]])
+
+        (a, b) = road
+        edges = [e for e in ((a, b), (b, a)) if self.weights.get(e) is not None]
+
+        indexed = None
+        if edges:
+            indexed = min(edges)
+            self.snap_edges.add(indexed, self.xy[indexed[0]], self.xy[indexed[1]])
+        self.snap_roads[road] = indexed
+
+    def _search_route(self, start, dest):
+        """
+        Searches for the least cost route between two snapped points.
+        Returns the (lat, long) points along it, or None, and the set of
+        edges whose costs it depends on
+        """
+        if start == dest:
+            return ([self._snap_coord(start)], frozenset())
+
+        route = None
+        if self._snaps_reachable(start, dest):
+            workspace = self._acquire_workspace()
+            try:
+                route = least_cost_route(self.G, self._sources(start), self._targets(dest), self._cost_function, workspace, self._budget())
+            finally:
+                self._release_workspace(workspace)
+        else:
+            self.logger.info("No route from {} to {}, rejected without searching".format(start, dest))
+
+        leg = self._join(start, dest, route)
+        if leg is None:
+            return (None, frozenset())
+
+        # The route depends on the roads its ends are snapped to, and on the
+        # edges it follows
+        edges = set()
+        for (u, v, t) in (start, dest):
+            if u != v:
+                edges.update([(u, v), (v, u)])
+        if route is not None:
+            edges.update(zip(route[1], route[1][1:]))
+
+        return (leg[1], frozenset(edges))
+
+    def _snaps_reachable(self, start, dest):
+        """
+        Returns True if there may be a route between two snapped points
+        through the graph
+        """
+        sources = self._sources(start)
+        targets = self._targets(dest)
+
+        return any(self._reachable(s, d) for s in sources for d in targets)
+
+    def _join(self, start, dest, route):
+        """
+        Given the least cost route between two snapped points through the
+        graph (or None), returns (cost, points) for the cheaper of it and
+        driving straight along a shared road, or None if neither exists
+        """
+        if start == dest:
+            return (0, [self._snap_coord(start)])
+
+        direct = self._direct_cost(start, dest)
+        if direct is not None and (route is None or direct <= route[0]):
+            return (direct, [self._snap_coord(start), self._snap_coord(dest)])
+
+        if route is None:
+            return None
+
+        return (route[0], self._route_points(start, dest, route[1]))
+
+    def _legs(self, stops, pairs):
+        """
+        Computes the least cost routes through the graph between snapped
+        stops, for each (a, b) pair of indexes into stops.  Every pair leaving
+        the same stop shares one search.  Returns a dict mapping each pair to
+        its route, or None
+        """
+        ends = {}
+        for (a, b) in pairs:
+            ends.setdefault(a, []).append(b)
+
+        legs = {}
+        budget = self._budget()
+        workspace = self._acquire_workspace()
+        try:
+            for (a, bs) in ends.items():
+                # Leaving out stops that cannot be reached keeps the shared
+                # search from exhausting the graph looking for them
+                bs = [b for b in bs if self._snaps_reachable(stops[a], stops[b])]
+                targets = [self._targets(stops[b]) for b in bs]
+
+                routes = least_cost_routes(self.G, self._sources(stops[a]), targets, self._cost_function, workspace, budget)
+                for (b, route) in zip(bs, routes):
+                    legs[(a, b)] = route
+        finally:
+            self._release_workspace(workspace)
+
+        for pair in pairs:
+            legs.setdefault(pair, None)
+
+        return legs
+
+    def _distance(self, start_coord, dest_coord):
+        """
+        Computes the cost in decimetres of the least cost route from
+        start_coord to dest_coord, or None if there is no route.  The cost
+        comes from the hub labels if they cover both ends, and from a search
+        otherwise
+        """
+        start = self._snap(start_coord)
+        dest = self._snap(dest_coord)
+        if start == dest:
+            return 0
+
+        sources = self._sources(start)
+        targets = self._targets(dest)
+
+        direct = self._direct_cost(start, dest)
+        costs = [] if direct is None else [direct]
+
+        # An edge update may drop the labels while this request runs
+        labels = self.labels
+        if labels is not None and all(v in labels for v in list(sources) + list(targets)):
+            for (s, sc) in sources.items():
+                for (d, dc) in targets.items():
+                    c = labels.cost(s, d)
+                    if c is not None:
+                        costs.append(sc + c + dc)
+
+        elif self._snaps_reachable(start, dest):
+            workspace = self._acquire_workspace()
+            try:
+                route = least_cost_route(self.G, sources, targets, self._cost_function, workspace, self._budget())
+            finally:
+                self._release_workspace(workspace)
+            if route is not None:
+                costs.append(route[0])
+
+        if not costs:
+            return None
+
+        return min(costs)
+
+    def _draw_lcp(self, start_coord, dest_coord, filename, margin=0.005):
+        """
+        Writes the part of the graph around the search for the least cost
+        route from start_coord to dest_coord to a dot file, with the route
+        and the vertices the search settled highlighted.  Returns the number
+        of vertices settled
+        """
+        start = self._snap(start_coord)
+        dest = self._snap(dest_coord)
+
+        workspace = self._acquire_workspace()
+        try:
+            route = least_cost_route(self.G, self._sources(start), self._targets(dest), self._cost_function, workspace)
+            settled = workspace.settled()
+        finally:
+            self._release_workspace(workspace)
+
+        path = route[1] if route else []
+        (V, E) = box_subgraph(self.G, self.names[0], route_box(self.names[0], path + settled, margin))
+        coords = dict((v, self.names[0][v]) for v in V)
+
+        with open(filename, 'w') as f:
+            write_dot(f, (V, E), 'digraph', search_attributes(coords, path, settled))
+
+        return len(settled)
+
+    def _multi_lcp(self, coords, reorder=False):
+        """
+        Computes a route visiting every point of coords in turn, or visiting
+        the points between the first and the last in a short order if reorder
+        is set.  Returns the (lat, long) points along the route, or None if
+        some leg has no route
+        """
+        # Snap all of the stops in one pass, only once for repeated stops
+        snapped = dict((coord, self._snap(coord)) for coord in set(coords))
+        stops = [snapped[coord] for coord in coords]
+        n = len(stops)
+
+        self.logger.info("Getting a route through {} stops".format(n))
+
+        order = list(range(n))
+        if reorder and n > 3:
+            pairs = [(a, b) for a in range(n - 1) for b in range(1, n) if a != b]
+        else:
+            reorder = False
+            pairs = list(zip(order, order[1:]))
+
+        legs = self._legs(stops, pairs)
+
+        if reorder:
+            matrix = [[None] * n for a in range(n)]
+            for (a, b) in pairs:
+                leg = self._join(stops[a], stops[b], legs[(a, b)])
+                if leg is not None:
+                    matrix[a][b] = leg[0]
+            order = order_stops(matrix)
+
+        # Stitch the legs together, each starting where the last one ended
+        points = []
+        for (a, b) in zip(order, order[1:]):
+            leg = self._join(stops[a], stops[b], legs[(a, b)])
+            if leg is None:
+                return None
+            points.extend(leg[1][1:] if points else leg[1])
+
+        return points
+
+    def _route_points(self, start, dest, path):
+        """
+        Returns the (lat, long) points along a path of vertices between two
+        snapped points
+        """
+        points = [self.names[0][v] for v in path]
+        if start[0] != start[1]:
+            points.insert(0, self._snap_coord(start))
+        if dest[0] != dest[1]:
+            points.append(self._snap_coord(dest))
+
+        return points
+
+    def _alternatives(self, start_coord, dest_coord, k=3):
+        """
+        Computes up to k alternative routes from start_coord to dest_coord,
+        best first, returning a list of the (lat, long) points along each
+        """
+        start = self._snap(start_coord)
+        dest = self._snap(dest_coord)
+
+        self.logger.info("Getting {} alternative routes from ({}) to ({})".format(k, start_coord, dest_coord))
+
+        if start == dest:
+            return [[self._snap_coord(start)]]
+
+        routes = []
+        if self._snaps_reachable(start, dest):
+            routes = alternative_paths(self.G, self._sources(start), self._targets(dest), self._cost_function, k, budget=self._budget())
+
+        paths = [self._route_points(start, dest, path) for (c, path) in routes]
+
+        # Driving straight along a shared road beats any detour through a vertex
+        direct = self._direct_cost(start, dest)
+        if direct is not None and (not routes or direct <= routes[0][0]):
+            paths = [[self._snap_coord(start), self._snap_coord(dest)]] + paths[:k - 1]
+
+        return paths
 
 if __name__ == '__main__':
     # Started directly, parse command line options...
@@ -390,7 +1525,7 @@ if __name__ == '__main__':
 
 else:
     # Started as module, prepare ms object for use with exported functions...
-    arguments = {'--graph': 'edmonton-roads-2.0.1.txt', '--help': False, '--logfile': 'MappingServer.log', '-v': False, '<port>': None, 'serial': False, 'shell': False, 'sock': False, 'stdin': True}
+    arguments = {'--graph': 'edmonton-roads-2.0.1.txt', '--help': False, '--logfile': 'MappingServer.log', '--largest-scc': False, '--snap': 'edge', '--reorder': False, '--labels': None, '--route-cache': '1024', '--processes': '0', '--port': '8089', '--deadline': None, '--max-expansions': '0', '--workers': '4', '--queue': '64', '--max-connections': '256', '-v': False, '<port>': None, 'serial': False, 'shell': False, 'sock': False, 'stdin': True}
     ms = MappingServer(arguments)
 
     def cost_distance(e):
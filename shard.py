@@ -0,0 +1,494 @@
+"""
+Usage:  shard.py split <tiledir> [options]
+        shard.py serve <tiledir> [options]
+
+Routing over a street digraph split into geographic tiles, each served by
+its own process, so that no process holds the whole graph.
+
+The graph is cut into --shards tiles of about the same number of vertices by
+splitting its bounding box again and again across its wider side.  A vertex
+with an edge to or from another tile is a boundary vertex.  Each tile worker
+holds only the vertices and edges of its tile.  The front router holds only
+the overlay: the boundary vertices, the edges between tiles, and for each
+tile the least cost inside the tile between every two of its boundary
+vertices, which the workers compute when they start.
+
+A route between two vertices is the best of the route inside one tile, when
+both are in it, and a route through the overlay.  For the overlay route the
+start tile gives the costs from the start to its boundary vertices, the
+destination tile gives the costs from its boundary vertices to the
+destination, and the front router searches the overlay between them.  The
+route is then unpacked by asking each tile it passes through for its part.
+
+Requests are snapped to the nearest vertex.
+
+Modes:
+    split: Splits --graph into tiles written to <tiledir>
+
+    serve: Starts a worker process for each tile in <tiledir> and serves the pipelined line
+        protocol of pipeline.py on localhost:--port.  Requests are two points, with the flags id=<tag>
+        and dist; the graph version in replies is always 1
+        example
+        >> shard.py split tiles --shards 4
+        >> shard.py serve tiles
+        >> printf 'ROUTE/1\\n5365488 -11333914 5364727 -11335890 dist\\n' | nc localhost 8091
+        ROUTE/1
+        0 1 OK 22345
+
+Options:
+  --graph <GRAPHFILE>  The file to load graph info [default: edmonton-roads-2.0.1.txt]
+  --shards <N>         The number of tiles to split the graph into [default: 4]
+  --port <PORT>        The localhost port to serve on [default: 8091]
+  -h --help
+
+"""
+
+import json
+import os
+import queue
+import signal
+import socket
+import threading
+from multiprocessing import Pipe, Process
+
+from async import run_async, BoundedExecutor
+from digraph import Digraph, least_cost_route, least_cost_path, shortest_path_tree, SearchWorkspace
+from geometry import Projection, project_graph, distance, SegmentIndex
+from pipeline import PROTOCOL, receive_greeting, parse_request, reply_line, serve_pipeline
+from readgraph import readgraph
+
+
+def partition(xy, shards):
+    """
+    Splits the vertices of the dict xy of projected points into shards
+    tiles of about the same size, returning a dict mapping each vertex to its
+    tile.
+
+    >>> xy = {1: (0, 0), 2: (10, 0), 3: (0, 1), 4: (10, 1)}
+    >>> sorted(partition(xy, 2).items())
+    [(1, 0), (2, 1), (3, 0), (4, 1)]
+    """
+    tiles = {}
+    todo = [(sorted(xy), 0, shards)]
+
+    while todo:
+        (vertices, first, count) = todo.pop()
+        if count == 1 or len(vertices) <= 1:
+            for v in vertices:
+                tiles[v] = first
+            continue
+
+        # Split across the wider side, in proportion to the tiles on each side
+        xs = [xy[v][0] for v in vertices]
+        ys = [xy[v][1] for v in vertices]
+        axis = 0 if max(xs) - min(xs) >= max(ys) - min(ys) else 1
+        vertices.sort(key=lambda v: (xy[v][axis], v))
+
+        left = count // 2
+        cut = len(vertices) * left // count
+        todo.append((vertices[:cut], first, left))
+        todo.append((vertices[cut:], first + left, count - left))
+
+    return tiles
+
+
+def split_graph(G, names, shards, tiledir):
+    """
+    Writes the tiles of G to tiledir: tile-<i>.txt for each tile, in the
+    format of readgraph, and overlay.txt with the projection origin, the
+    number of tiles, the tile of every boundary vertex and the edges between
+    tiles with their costs.  Returns the number of boundary vertices.
+    """
+    (projection, xy, lengths) = project_graph(G, names[0])
+    (V_coord, E_name) = names[:2]
+    tiles = partition(xy, shards)
+
+    cut = [e for e in lengths if tiles[e[0]] != tiles[e[1]]]
+    boundary = set(v for e in cut for v in e)
+
+    os.makedirs(tiledir, exist_ok=True)
+    for t in range(shards):
+        with open(os.path.join(tiledir, 'tile-{}.txt'.format(t)), 'w') as f:
+            for v in sorted(V_coord):
+                if tiles[v] == t:
+                    f.write('V,{},{!r},{!r}\n'.format(v, V_coord[v][0], V_coord[v][1]))
+            for e in sorted(lengths):
+                if tiles[e[0]] == tiles[e[1]] == t:
+                    f.write('E,{},{},"{}"\n'.format(e[0], e[1], E_name[e]))
+
+    with open(os.path.join(tiledir, 'overlay.txt'), 'w') as f:
+        f.write('O,{!r},{!r}\n'.format(projection.origin[0], projection.origin[1]))
+        f.write('T,{}\n'.format(shards))
+        for v in sorted(boundary):
+            f.write('B,{},{}\n'.format(v, tiles[v]))
+        for e in sorted(cut):
+            f.write('E,{},{},{}\n'.format(e[0], e[1], lengths[e]))
+
+    return len(boundary)
+
+
+class Tile:
+    """
+    The part of the graph in one tile, as served by a tile worker.  Costs
+    are edge lengths in decimetres on the projection about origin, which
+    every tile shares.
+    """
+
+    def __init__(self, filename, origin, boundary):
+        """
+        Arguments:
+            filename    the tile file written by split_graph
+            origin      the (lat, long) the projection is centred on
+            boundary    the boundary vertices of the tile
+        """
+        (self.G, names) = readgraph(filename)
+        self.coords = names[0]
+
+        projection = Projection([origin])
+        self.xy = dict((v, projection.project(coord)) for (v, coord) in self.coords.items())
+        self.weights = dict((e, distance(self.xy[e[0]], self.xy[e[1]])) for e in self.G.edges())
+        self.boundary = [v for v in boundary if v in self.coords]
+
+        self.vertices = SegmentIndex((v, p, p) for (v, p) in self.xy.items())
+        self.workspace = SearchWorkspace(self.G)
+
+    def bounds(self):
+        """
+        Returns the (x0, y0, x1, y1) bounding box of the vertices of the tile
+        """
+        xs = [p[0] for p in self.xy.values()]
+        ys = [p[1] for p in self.xy.values()]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    def snap(self, point):
+        """
+        Returns (d2, v) for the vertex v of the tile nearest to point, at a
+        squared distance of d2
+        """
+        (d2, v, t) = self.vertices.nearest(point)
+        return (d2, v)
+
+    def boundary_costs(self):
+        """
+        Returns a dict mapping each (a, b) pair of boundary vertices to the
+        least cost from a to b inside the tile, where there is a route
+        """
+        costs = {}
+        for a in self.boundary:
+            tree = shortest_path_tree(self.G, {a: 0}, self.weights.get)
+            for b in self.boundary:
+                if b != a and b in tree:
+                    costs[(a, b)] = tree[b][0]
+
+        return costs
+
+    def leave(self, v):
+        """
+        Returns a dict mapping each boundary vertex reachable from v inside
+        the tile to the cost of getting there
+        """
+        tree = shortest_path_tree(self.G, {v: 0}, self.weights.get)
+        return dict((b, tree[b][0]) for b in self.boundary if b in tree)
+
+    def enter(self, v):
+        """
+        Returns a dict mapping each boundary vertex that reaches v inside the
+        tile to the cost of the rest of the way
+        """
+        tree = shortest_path_tree(self.G, {v: 0}, self.weights.get, reverse=True)
+        return dict((b, tree[b][0]) for b in self.boundary if b in tree)
+
+    def route(self, start, dest):
+        """
+        Returns (cost, points) for the least cost route from start to dest
+        inside the tile, or None
+        """
+        route = least_cost_route(self.G, {start: 0}, {dest: 0}, self.weights.get, self.workspace)
+        if route is None:
+            return None
+
+        return (route[0], [self.coords[v] for v in route[1]])
+
+    def path(self, start, dest):
+        """
+        Returns the (lat, long) points along the least cost path from start
+        to dest inside the tile
+        """
+        return [self.coords[v] for v in least_cost_path(self.G, start, dest, self.weights.get, self.workspace)]
+
+
+def _serve_tile(connection, filename, origin, boundary):
+    """
+    Runs a tile worker, answering calls of the methods of its Tile over
+    connection until it is closed.  A call is a list of (method, args)
+    pairs, answered with the list of their results.
+    """
+    # The front router stops its workers itself, after an interrupt from
+    # the terminal reaches all of them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    tile = Tile(filename, origin, boundary)
+    connection.send('ready')
+
+    while True:
+        try:
+            calls = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            connection.send([getattr(tile, method)(*args) for (method, args) in calls])
+        except Exception as e:
+            connection.send(e)
+
+
+class ShardRouter:
+    """
+    The front router: starts a worker process for each tile, and routes
+    requests through the overlay.
+    """
+
+    def __init__(self, tiledir):
+        """
+        Arguments:
+            tiledir     the directory split_graph wrote the tiles to
+        """
+        self.tile = {}
+        self.overlay = Digraph()
+        self.weights = {}
+
+        with open(os.path.join(tiledir, 'overlay.txt')) as f:
+            for line in f:
+                fields = line.rstrip().split(',')
+                if fields[0] == 'O':
+                    origin = (float(fields[1]), float(fields[2]))
+                elif fields[0] == 'T':
+                    shards = int(fields[1])
+                elif fields[0] == 'B':
+                    self.tile[int(fields[1])] = int(fields[2])
+                    self.overlay.add_vertex(int(fields[1]))
+                elif fields[0] == 'E':
+                    e = (int(fields[1]), int(fields[2]))
+                    self.overlay.add_edge(e)
+                    self.weights[e] = int(fields[3])
+
+        self.projection = Projection([origin])
+
+        # One pipe to each worker, used by one request at a time
+        self.connections = []
+        self.locks = []
+        self.processes = []
+        for t in range(shards):
+            boundary = [v for v in self.tile if self.tile[v] == t]
+            (ours, theirs) = Pipe()
+            process = Process(target=_serve_tile, args=(theirs, os.path.join(tiledir, 'tile-{}.txt'.format(t)), origin, boundary))
+            process.daemon = True
+            process.start()
+
+            self.connections.append(ours)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+
+        for connection in self.connections:
+            connection.recv()
+
+        # Within each tile, the overlay joins every two boundary vertices
+        # with the least cost between them inside the tile
+        results = self._call([(t, 'boundary_costs', ()) for t in range(shards)] +
+                             [(t, 'bounds', ()) for t in range(shards)])
+        for costs in results[:shards]:
+            for (e, c) in costs.items():
+                self.overlay.add_edge(e)
+                self.weights[e] = c
+        self.bounds = results[shards:]
+
+        self.workspace = SearchWorkspace(self.overlay)
+        self.workspace_lock = threading.Lock()
+
+    def _call(self, calls):
+        """
+        Makes a list of (tile, method, args) calls of tile workers, returning
+        the list of their results.  The calls to each worker go together,
+        and different workers work on them at the same time.
+        """
+        by_tile = {}
+        for (i, (t, method, args)) in enumerate(calls):
+            by_tile.setdefault(t, []).append((i, method, args))
+
+        # Taking the locks in tile order keeps two requests from each holding
+        # a worker the other is waiting for
+        tiles = sorted(by_tile)
+        for t in tiles:
+            self.locks[t].acquire()
+
+        results = [None] * len(calls)
+        try:
+            for t in tiles:
+                self.connections[t].send([(method, args) for (i, method, args) in by_tile[t]])
+            for t in tiles:
+                reply = self.connections[t].recv()
+                if isinstance(reply, Exception):
+                    raise reply
+                for ((i, method, args), result) in zip(by_tile[t], reply):
+                    results[i] = result
+        finally:
+            for t in tiles:
+                self.locks[t].release()
+
+        return results
+
+    def snap(self, coord):
+        """
+        Snaps a coordinate in 100,000ths of degrees to the nearest vertex,
+        returning (tile, vertex)
+        """
+        point = self.projection.project((coord[0] / 100000, coord[1] / 100000))
+
+        # The squared distance from the point to the bounding box of each tile
+        near = []
+        for (t, (x0, y0, x1, y1)) in enumerate(self.bounds):
+            dx = max(x0 - point[0], 0, point[0] - x1)
+            dy = max(y0 - point[1], 0, point[1] - y1)
+            near.append((dx * dx + dy * dy, t))
+        near.sort()
+
+        # Ask the nearest tile first, then any tile that may hold a nearer vertex
+        (d2, v) = self._call([(near[0][1], 'snap', (point,))])[0]
+        best = (d2, near[0][1], v)
+
+        others = [t for (b2, t) in near[1:] if b2 < best[0]]
+        for (t, (d2, v)) in zip(others, self._call([(t, 'snap', (point,)) for t in others])):
+            if d2 < best[0]:
+                best = (d2, t, v)
+
+        return best[1:]
+
+    def route(self, start_coord, dest_coord):
+        """
+        Returns (cost, points) for the least cost route between two
+        coordinates in 100,000ths of degrees, or None if there is no route
+        """
+        (ts, s) = self.snap(start_coord)
+        (tt, t) = self.snap(dest_coord)
+        if s == t:
+            return (0, self._call([(ts, 'path', (s, s))])[0])
+
+        calls = [(ts, 'leave', (s,)), (tt, 'enter', (t,))]
+        if ts == tt:
+            calls.append((ts, 'route', (s, t)))
+        results = self._call(calls)
+        (sources, targets) = results[:2]
+        local = results[2] if ts == tt else None
+
+        with self.workspace_lock:
+            route = least_cost_route(self.overlay, sources, targets, self.weights.get, self.workspace)
+
+        if route is None or (local is not None and local[0] <= route[0]):
+            return local
+
+        # Cut the overlay path into the parts inside each tile, which are
+        # joined by edges between tiles
+        (cost, path) = route
+        parts = []
+        first = s
+        for (a, b) in zip(path, path[1:]):
+            if self.tile[a] != self.tile[b]:
+                parts.append((self.tile[a], 'path', (first, a)))
+                first = b
+        parts.append((tt, 'path', (first, t)))
+
+        points = []
+        for part in self._call(parts):
+            points.extend(part)
+
+        return (cost, points)
+
+    def close(self):
+        """
+        Stops the tile workers
+        """
+        # Every worker holds copies of the pipes of the workers started
+        # before it, so closing them does not end the workers
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+
+@run_async
+def _serve_connection(router, executor, window_size, connection):
+    """
+    Serves the pipelined line protocol on a connection until the client
+    closes it
+    """
+    def submit(line, count):
+        try:
+            (points, flags) = parse_request(line, ('id', 'dist'))
+            if len(points) != 2:
+                raise ValueError("Expected two points, got {}".format(len(points)))
+        except (ValueError, UnicodeDecodeError):
+            return (count, None, 'ERR invalid request', False)
+
+        tag = flags.get('id') or count
+        try:
+            return (tag, executor.submit(router.route, points[0], points[1]), None, 'dist' in flags)
+        except queue.Full:
+            return (tag, None, 'BUSY', False)
+
+    def reply(tag, future, reply, dist):
+        # The graph of a shard router is never reloaded
+        return reply_line(tag, 1, future, reply, lambda route: route[0] if dist else json.dumps(route[1]))
+
+    try:
+        (greeting, pending) = receive_greeting(connection)
+        if greeting != PROTOCOL:
+            connection.sendall(b'ERR unsupported protocol ' + greeting + b'\n')
+            return
+        serve_pipeline(connection, pending, submit, reply, window_size)
+
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+
+def serve(router, port, threads):
+    """
+    Serves the pipelined line protocol on localhost:port until interrupted,
+    routing requests on a pool of threads
+    """
+    executor = BoundedExecutor(threads, 64)
+
+    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    serversocket.bind(('localhost', port))
+    serversocket.listen(10)
+
+    try:
+        while True:
+            (connection, address) = serversocket.accept()
+            _serve_connection(router, executor, threads, connection)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        serversocket.close()
+
+
+if __name__ == '__main__':
+    import docopt
+
+    arguments = docopt.docopt(__doc__)
+    shards = int(arguments['--shards'])
+
+    if arguments['split']:
+        (G, names) = readgraph(arguments['--graph'])
+        boundary = split_graph(G, names, shards, arguments['<tiledir>'])
+        print("split {} vertices into {} tiles, with {} boundary vertices".format(G.num_vertices(), shards, boundary))
+
+    elif arguments['serve']:
+        router = ShardRouter(arguments['<tiledir>'])
+
+        # A thread for each worker can keep every worker busy, and one more
+        # for each can be searching the overlay or waiting to send
+        serve(router, int(arguments['--port']), 2 * len(router.connections))
+        router.close()
@@ -0,0 +1,117 @@
+"""
+Orders the stops of a multi-stop route.
+
+Given a matrix of the cost of driving from each stop to each other stop,
+finds a short order to visit them in that starts at the first stop and ends
+at the last one.  The matrix need not be symmetric (one way streets), and an
+entry of None means there is no route between the two stops.
+
+The order is built by nearest insertion and then improved with 2-opt moves,
+which is quick and usually within a few percent of the best order for the
+10 to 50 stops of a delivery run.
+
+>>> m = [[0, 1, 5, 2], [1, 0, 2, 4], [5, 2, 0, 1], [2, 4, 1, 0]]
+>>> order_stops(m)
+[0, 1, 2, 3]
+>>> tour_cost([0, 2, 1, 3], m)
+11
+"""
+
+INFINITY = float('inf')
+
+
+def tour_cost(order, matrix):
+    """
+    Returns the cost of visiting the stops in order, or infinity if some leg
+    has no route.
+    """
+    total = 0
+    for (a, b) in zip(order, order[1:]):
+        c = matrix[a][b]
+        if c is None:
+            return INFINITY
+        total += c
+
+    return total
+
+
+def _leg(matrix, a, b):
+    c = matrix[a][b]
+    if c is None:
+        return INFINITY
+    return c
+
+
+def nearest_insertion(matrix):
+    """
+    Builds an order from the first stop to the last by repeatedly taking the
+    stop nearest to the order so far, and inserting it where it adds the
+    least cost.
+
+    >>> m = [[0, 4, 1, 9], [4, 0, 2, 1], [1, 2, 0, 6], [9, 1, 6, 0]]
+    >>> nearest_insertion(m)
+    [0, 2, 1, 3]
+    """
+    n = len(matrix)
+    if n <= 2:
+        return list(range(n))
+
+    order = [0, n - 1]
+    left = set(range(1, n - 1))
+
+    # nearest[s] is the cost between s and the closest stop in the order
+    nearest = dict((s, min(_leg(matrix, 0, s), _leg(matrix, s, n - 1))) for s in left)
+
+    while left:
+        s = min(left, key=lambda s: (nearest[s], s))
+        left.remove(s)
+
+        position = min(range(1, len(order)),
+                       key=lambda i: _leg(matrix, order[i - 1], s) + _leg(matrix, s, order[i]) - _leg(matrix, order[i - 1], order[i]))
+        order.insert(position, s)
+
+        for t in left:
+            nearest[t] = min(nearest[t], _leg(matrix, s, t), _leg(matrix, t, s))
+
+    return order
+
+
+def two_opt(order, matrix):
+    """
+    Improves an order by reversing runs of stops between its fixed ends,
+    for as long as some reversal makes it cheaper.
+
+    >>> m = [[0, 4, 1, 9], [4, 0, 2, 1], [1, 2, 0, 6], [9, 1, 6, 0]]
+    >>> two_opt([0, 1, 2, 3], m)
+    [0, 2, 1, 3]
+    """
+    order = list(order)
+    best = tour_cost(order, matrix)
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(order) - 2):
+            for j in range(i + 1, len(order) - 1):
+                # With one way streets every leg inside the run changes
+                # direction, so cost the whole candidate
+                candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                c = tour_cost(candidate, matrix)
+                if c < best:
+                    (order, best) = (candidate, c)
+                    improved = True
+
+    return order
+
+
+def order_stops(matrix):
+    """
+    Returns a short order to visit every stop of the cost matrix in, from the
+    first stop to the last.
+    """
+    return two_opt(nearest_insertion(matrix), matrix)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()